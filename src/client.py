@@ -271,7 +271,16 @@ class WelcomedClient(GObject.GObject):
             self.remove_package(pkg)
 
     def check_updates(self):
+        """ Queues an update check. The updates come in command-finished """
         return self.dbus_proxy.check_updates()
 
+    def get_cached_updates(self):
+        """ Result of the last update check """
+        return self.dbus_proxy.get_cached_updates()
+
+    def get_metrics(self):
+        """ Daemon metrics (sample name -> value) """
+        return self.dbus_proxy.get_metrics()
+
     def system_upgrade(self):
         return self.dbus_proxy.system_upgrade()
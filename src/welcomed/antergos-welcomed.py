@@ -20,6 +20,9 @@
 #  You should have received a copy of the GNU General Public License
 #  along with Antergos-welcome. If not, see <http://www.gnu.org/licenses/>.
 
+import time
+START_TIME = time.monotonic()
+
 import optparse
 import logging
 import gettext
@@ -34,8 +37,11 @@ from gi.repository import GLib
 from pydbus import SessionBus, SystemBus
 
 # DBus service
+import dispatch
 import service
 
+IMPORTS_TIME = time.monotonic() - START_TIME
+
 APP_NAME = "antergos-welcomed"
 LOCALE_DIR = "/usr/share/locale"
 
@@ -55,6 +61,71 @@ def parse_argv():
         dest='verbose', default=False,
         help=_('Send logging messages to stdout instead of stderr.'))
 
+    parser.add_option(
+        '-a', '--auth-ttl', type='int',
+        dest='auth_ttl', default=60,
+        help=_('Seconds a polkit authorization is remembered per client (0 disables it).'))
+
+    parser.add_option(
+        '-p', '--progress-rate', type='float',
+        dest='progress_rate', default=4,
+        help=_('Maximum number of progress signals per second and job.'))
+
+    parser.add_option(
+        '-u', '--updates-ttl', type='int',
+        dest='updates_ttl', default=1800,
+        help=_('Seconds the result of an update check is reused.'))
+
+    parser.add_option(
+        '-r', '--refresh-min-age', type='int',
+        dest='refresh_min_age', default=300,
+        help=_('Seconds before a repo database is checked again on refresh.'))
+
+    parser.add_option(
+        '-f', '--prefetch', action='store_true',
+        dest='prefetch', default=False,
+        help=_('Download available updates in the background.'))
+
+    parser.add_option(
+        '-m', '--probe-mirrors', action='store_true',
+        dest='probe_mirrors', default=False,
+        help=_('Measure mirror speed before refreshing the databases.'))
+
+    parser.add_option(
+        '-H', '--hedge-delay', type='float',
+        dest='hedge_delay', default=3,
+        help=_('Seconds without data before a download is also requested from the next mirror (0 disables it).'))
+
+    parser.add_option(
+        '-w', '--fetch-workers', type='int',
+        dest='fetch_workers', default=4,
+        help=_('Number of packages downloaded at the same time.'))
+
+    parser.add_option(
+        '-k', '--cache-keep', type='int',
+        dest='cache_keep', default=3,
+        help=_('Versions of each package kept when cleaning the package cache.'))
+
+    parser.add_option(
+        '-b', '--cache-budget', type='int',
+        dest='cache_budget', default=4096,
+        help=_('Maximum size (MiB) of the package cache after cleaning it (0 for no limit).'))
+
+    parser.add_option(
+        '-i', '--idle-timeout', type='int',
+        dest='idle_timeout', default=0,
+        help=_('Exit after these minutes without clients nor jobs (0 disables it).'))
+
+    parser.add_option(
+        '-t', '--dbus-threads', type='int',
+        dest='dbus_threads', default=4,
+        help=_('Number of threads answering slow D-Bus method calls.'))
+
+    parser.add_option(
+        '-M', '--metrics-textfile',
+        dest='metrics_textfile', default=None,
+        help=_('Write metrics to this file for the node_exporter textfile collector.'))
+
     (opts, args) = parser.parse_args()
     return opts, args
 
@@ -119,8 +190,35 @@ if __name__ == '__main__':
     setup_logging(argv_options)
 
     mainloop = GLib.MainLoop()
+    start_time = time.monotonic()
     bus = SystemBus()
+    bus_time = time.monotonic() - start_time
     logging.debug(_("Connected to the system bus"))
-    bus.publish("com.antergos.welcome", service.DBusService(mainloop))
+    start_time = time.monotonic()
+    dbus_service = service.DBusService(
+        mainloop, bus=bus, auth_ttl=argv_options.auth_ttl,
+        progress_rate=argv_options.progress_rate,
+        updates_ttl=argv_options.updates_ttl,
+        refresh_min_age=argv_options.refresh_min_age,
+        prefetch=argv_options.prefetch,
+        probe_mirrors=argv_options.probe_mirrors,
+        hedge_delay=argv_options.hedge_delay,
+        fetch_workers=argv_options.fetch_workers,
+        cache_keep=argv_options.cache_keep,
+        cache_budget=argv_options.cache_budget,
+        idle_timeout=argv_options.idle_timeout * 60,
+        metrics_textfile=argv_options.metrics_textfile)
+    service_time = time.monotonic() - start_time
+    start_time = time.monotonic()
+    dbus_service.publication = dispatch.Publication(
+        bus, "com.antergos.welcome", dbus_service,
+        max_workers=argv_options.dbus_threads,
+        call_observer=dbus_service.observe_call)
+    publish_time = time.monotonic() - start_time
+    logging.debug(
+        "Startup times: imports %.3fs, bus connection %.3fs, service %.3fs "
+        "(pacman.conf %.3fs), bus publish %.3fs. Total %.3fs",
+        IMPORTS_TIME, bus_time, service_time, dbus_service.startup_times.get('config', 0),
+        publish_time, time.monotonic() - START_TIME)
 
     mainloop.run()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  authcache.py
+#
+#  Copyright © 2015-2017 Antergos
+#
+#  This file is part of antergos-welcome
+#
+#  Antergos-welcome is free software: you can redistribute it and/or modify
+#  it under the temms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Antergos-welcome is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Antergos-welcome. If not, see <http://www.gnu.org/licenses/>.
+
+""" Cache of polkit authorizations per D-Bus sender """
+
+import threading
+import time
+
+
+class AuthorizationCache(object):
+    """ Remembers granted (sender, action_id) pairs for ttl seconds.
+        Only positive answers are stored, so a cancelled password dialog
+        is asked again on the next call. Entries of a sender are dropped
+        as soon as it leaves the bus (NameOwnerChanged). """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._granted = {}
+        self._lock = threading.Lock()
+
+    def is_granted(self, sender, action_id):
+        if not sender or self.ttl <= 0:
+            return False
+        with self._lock:
+            expires = self._granted.get((sender, action_id))
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self._granted[(sender, action_id)]
+                return False
+            return True
+
+    def grant(self, sender, action_id):
+        if not sender or self.ttl <= 0:
+            return
+        with self._lock:
+            self._granted[(sender, action_id)] = time.monotonic() + self.ttl
+
+    def forget(self, sender):
+        """ Removes all authorizations of sender """
+        with self._lock:
+            for key in [key for key in self._granted if key[0] == sender]:
+                del self._granted[key]
+
+    def clear(self):
+        with self._lock:
+            self._granted.clear()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  dblock.py
+#
+#  Copyright © 2015-2017 Antergos
+#
+#  This file is part of antergos-welcome
+#
+#  Antergos-welcome is free software: you can redistribute it and/or modify
+#  it under the temms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Antergos-welcome is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Antergos-welcome. If not, see <http://www.gnu.org/licenses/>.
+
+""" Waits for pacman's db.lck to be released without polling """
+
+import logging
+import os
+import threading
+import time
+
+import gi
+gi.require_version('GLib', '2.0')
+from gi.repository import Gio
+
+
+class DbLockWatcher(object):
+    """ Watches DBPath (inotify through a Gio directory monitor, dispatched
+        by the GLib main loop) and wakes up waiting threads as soon as
+        db.lck is deleted. A lock file that no process holds open is
+        considered stale and is removed. """
+
+    def __init__(self, db_path, stale_check_delay=5):
+        self.db_path = db_path
+        self.lock_file = os.path.join(db_path, "db.lck")
+        # Seconds to wait between stale lock checks
+        self.stale_check_delay = stale_check_delay
+        self._changed = threading.Event()
+        self.monitor = None
+        try:
+            directory = Gio.File.new_for_path(db_path)
+            self.monitor = directory.monitor_directory(
+                Gio.FileMonitorFlags.NONE, None)
+            self.monitor.connect("changed", self._on_changed)
+        except Exception as err:
+            logging.warning("Cannot monitor %s: %s", db_path, err)
+
+    def _on_changed(self, monitor, changed_file, other_file, event_type):
+        if changed_file.get_path() == self.lock_file and \
+                event_type == Gio.FileMonitorEvent.DELETED:
+            self._changed.set()
+
+    def is_locked(self):
+        return os.path.exists(self.lock_file)
+
+    def get_lock_owners(self):
+        """ Returns the pids of the processes that have db.lck open """
+        owners = []
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            fd_dir = os.path.join('/proc', pid, 'fd')
+            try:
+                for fd in os.listdir(fd_dir):
+                    if os.readlink(os.path.join(fd_dir, fd)) == self.lock_file:
+                        owners.append(int(pid))
+                        break
+            except OSError:
+                # Process is gone or we are not allowed to look at it
+                continue
+        return owners
+
+    def remove_stale_lock(self):
+        """ Removes db.lck if no process owns it. Returns True if removed """
+        if not self.is_locked() or self.get_lock_owners():
+            return False
+        logging.warning("Removing stale lock file %s", self.lock_file)
+        try:
+            os.unlink(self.lock_file)
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            logging.error("Cannot remove %s: %s", self.lock_file, err)
+            return False
+        return True
+
+    def wait(self, timeout=None):
+        """ Blocks until db.lck is released (or timeout seconds have passed).
+            Returns True if the lock is free """
+        start_time = time.monotonic()
+        while True:
+            self._changed.clear()
+            if not self.is_locked() or self.remove_stale_lock():
+                return True
+            delay = self.stale_check_delay
+            if timeout is not None:
+                remaining = timeout - (time.monotonic() - start_time)
+                if remaining <= 0:
+                    return False
+                delay = min(delay, remaining)
+            self._changed.wait(delay)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  dispatch.py
+#
+#  Copyright © 2015-2017 Antergos
+#
+#  This file is part of antergos-welcome
+#
+#  Antergos-welcome is free software: you can redistribute it and/or modify
+#  it under the temms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Antergos-welcome is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Antergos-welcome. If not, see <http://www.gnu.org/licenses/>.
+
+""" Asynchronous D-Bus method dispatch
+
+    pydbus runs every method in the GLib main loop and replies with what it
+    returns, so a slow method makes every other client wait. Methods marked
+    with @threaded run instead in a bounded pool of threads, and the reply
+    is sent from there when they finish (GDBus can reply from any thread).
+
+    Methods marked with @authorized(action_id) are only called once polkit
+    has authorized the caller. Meanwhile the call is parked, so a password
+    dialog left open doesn't stop anyone else from being served. If polkit
+    says no, the caller gets empty values ("", False, []).
+"""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import gi
+gi.require_version('GLib', '2.0')
+gi.require_version('Gio', '2.0')
+from gi.repository import GLib, Gio
+
+from pydbus.registration import ObjectRegistration, ObjectWrapper
+
+
+def threaded(fast_path=None):
+    """ Runs the decorated D-Bus method in the handler pool. If
+        fast_path(self, *args) returns True (the answer is in a warm
+        cache), the call is answered inline instead. """
+    def decorator(method):
+        method.dbus_threaded = True
+        method.dbus_fast_path = fast_path
+        return method
+    return decorator
+
+
+def authorized(action_id):
+    """ The decorated D-Bus method is only run if polkit authorizes the
+        caller to do action_id. The object must have an
+        authorize(connection, sender, action_id, callback) method that
+        calls callback(authorized) when the answer is known. """
+    def decorator(method):
+        method.dbus_action_id = action_id
+        return method
+    return decorator
+
+
+def _empty_value(signature):
+    """ Value returned to callers that are not authorized """
+    if signature.startswith('a{'):
+        return {}
+    if signature.startswith('a'):
+        return []
+    if signature in ('s', 'o', 'g'):
+        return ""
+    if signature == 'b':
+        return False
+    if signature == 'd':
+        return 0.0
+    return 0
+
+
+class AsyncObjectWrapper(ObjectWrapper):
+    """ ObjectWrapper that waits for polkit before calling @authorized
+        methods, and runs @threaded methods in executor """
+
+    def __init__(self, object, interfaces, executor, call_observer=None):
+        super(AsyncObjectWrapper, self).__init__(object, interfaces)
+        self.executor = executor
+        # Called as call_observer(method_name, seconds) after each reply
+        self.call_observer = call_observer
+
+    def call_method(self, connection, sender, object_path, interface_name,
+                    method_name, parameters, invocation):
+        start_time = time.monotonic()
+        method = getattr(self.object, method_name, None)
+        action_id = getattr(method, 'dbus_action_id', None)
+        if action_id is None:
+            self._dispatch(connection, sender, object_path, interface_name,
+                           method_name, parameters, invocation, start_time)
+            return
+
+        def on_authorized(authorized):
+            if authorized:
+                self._dispatch(connection, sender, object_path, interface_name,
+                               method_name, parameters, invocation, start_time)
+            else:
+                logging.info("%s is not authorized to call %s", sender, method_name)
+                self._return_empty(interface_name, method_name, invocation, start_time)
+
+        try:
+            self.object.authorize(connection, sender, action_id, on_authorized)
+        except Exception as err:
+            logging.error("Cannot check authorization of %s: %s", sender, err)
+            self._return_empty(interface_name, method_name, invocation, start_time)
+
+    def _observe(self, method_name, start_time):
+        if self.call_observer is not None:
+            self.call_observer(method_name, time.monotonic() - start_time)
+
+    def _return_empty(self, interface_name, method_name, invocation, start_time):
+        outargs = self.outargs[interface_name + "." + method_name]
+        if not outargs:
+            invocation.return_value(None)
+        else:
+            values = tuple(_empty_value(signature) for signature in outargs)
+            invocation.return_value(GLib.Variant("(" + "".join(outargs) + ")", values))
+        self._observe(method_name, start_time)
+
+    def _call(self, connection, sender, object_path, interface_name,
+              method_name, parameters, invocation, start_time):
+        """ Runs the method and replies (pydbus does both) """
+        super(AsyncObjectWrapper, self).call_method(
+            connection, sender, object_path, interface_name, method_name,
+            parameters, invocation)
+        self._observe(method_name, start_time)
+
+    def _dispatch(self, connection, sender, object_path, interface_name,
+                  method_name, parameters, invocation, start_time):
+        method = getattr(self.object, method_name, None)
+        if getattr(method, 'dbus_threaded', False):
+            fast_path = method.dbus_fast_path
+            try:
+                inline = fast_path is not None and fast_path(self.object, *parameters)
+            except Exception as err:
+                logging.debug("%s fast path failed: %s", method_name, err)
+                inline = False
+            if not inline:
+                self.executor.submit(
+                    self._call, connection, sender, object_path, interface_name,
+                    method_name, parameters, invocation, start_time)
+                return
+        self._call(connection, sender, object_path, interface_name, method_name,
+                   parameters, invocation, start_time)
+
+
+class Publication(object):
+    """ Same as pydbus' bus.publish(bus_name, object), but methods of
+        object marked with @threaded are run in a pool of max_workers
+        threads. call_observer(method_name, seconds) is told how long
+        each call took, from its arrival to its reply. """
+
+    def __init__(self, bus, bus_name, object, path=None, max_workers=4,
+                 call_observer=None):
+        if path is None:
+            path = "/" + bus_name.replace(".", "/")
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        node_info = Gio.DBusNodeInfo.new_for_xml(type(object).__doc__)
+        interfaces = node_info.interfaces
+        wrapper = AsyncObjectWrapper(object, interfaces, self.executor, call_observer)
+        self.registration = ObjectRegistration(
+            bus, path, interfaces, wrapper, own_wrapper=True)
+        # Request name only after registering the object
+        self.name_owner = bus.request_name(bus_name)
+
+    def unpublish(self):
+        """ Releases the bus name and stops taking calls. Calls already
+            in the handler pool still run (see wait). """
+        self.name_owner.unown()
+        self.registration.unregister()
+        self.executor.shutdown(wait=False)
+
+    def wait(self):
+        """ Waits until the calls left in the handler pool have been
+            answered. Must not be called from the main loop. """
+        self.executor.shutdown(wait=True)
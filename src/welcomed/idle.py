@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  idle.py
+#
+#  Copyright © 2015-2017 Antergos
+#
+#  This file is part of antergos-welcome
+#
+#  Antergos-welcome is free software: you can redistribute it and/or modify
+#  it under the temms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Antergos-welcome is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Antergos-welcome. If not, see <http://www.gnu.org/licenses/>.
+
+""" Idle detection, so the daemon can exit and be D-Bus activated again """
+
+import threading
+import time
+
+import gi
+gi.require_version('GLib', '2.0')
+from gi.repository import GLib
+
+# Seconds between idle checks
+CHECK_INTERVAL = 30
+
+
+class IdleMonitor(object):
+    """ Calls on_idle() (from the GLib main loop) once nothing has happened
+        for timeout seconds. Something is happening while is_busy() returns
+        True (jobs queued or running), while a client that has called us is
+        still connected to the bus, or if a method has been called less than
+        timeout seconds ago. A timeout of 0 disables it. """
+
+    def __init__(self, timeout, is_busy, on_idle):
+        self.timeout = timeout
+        self.is_busy = is_busy
+        self.on_idle = on_idle
+        self._last_activity = time.monotonic()
+        self._clients = set()
+        self._lock = threading.Lock()
+        self._source_id = None
+
+    def start(self):
+        if self.timeout > 0 and self._source_id is None:
+            interval = max(1, min(CHECK_INTERVAL, int(self.timeout)))
+            self._source_id = GLib.timeout_add_seconds(interval, self._check)
+
+    def stop(self):
+        if self._source_id is not None:
+            GLib.source_remove(self._source_id)
+            self._source_id = None
+
+    def touch(self, sender=None):
+        """ Registers a method call (from sender, if known) """
+        with self._lock:
+            self._last_activity = time.monotonic()
+            if sender:
+                self._clients.add(sender)
+
+    def forget_client(self, sender):
+        """ sender has left the bus """
+        with self._lock:
+            if sender in self._clients:
+                self._clients.discard(sender)
+                # Give it a full timeout in case it comes back
+                self._last_activity = time.monotonic()
+
+    def is_idle(self):
+        with self._lock:
+            if self._clients:
+                return False
+            if time.monotonic() - self._last_activity < self.timeout:
+                return False
+        return not self.is_busy()
+
+    def _check(self):
+        if not self.is_idle():
+            return True
+        self._source_id = None
+        self.on_idle()
+        return False
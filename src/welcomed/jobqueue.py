@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  jobqueue.py
+#
+#  Copyright © 2015-2017 Antergos
+#
+#  This file is part of antergos-welcome
+#
+#  Antergos-welcome is free software: you can redistribute it and/or modify
+#  it under the temms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Antergos-welcome is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Antergos-welcome. If not, see <http://www.gnu.org/licenses/>.
+
+""" Priority queue of welcomed jobs """
+
+import heapq
+import itertools
+import threading
+import time
+
+# Lower runs first. Jobs with the same priority run in FIFO order.
+JOB_PRIORITIES = {
+    'refresh': 0,
+    'check_updates': 0,
+    'frontend_loaded': 0,
+    'install': 1,
+    'install_packages': 1,
+    'remove': 1,
+    'system_upgrade': 2,
+    'prefetch': 3,
+    'clean_cache': 3}
+
+DEFAULT_PRIORITY = 1
+
+# Jobs that transactions queued after them can't overtake (installing a
+# package before a pending system upgrade would be a partial upgrade)
+BARRIERS = ('system_upgrade',)
+# Jobs with this priority don't change installed packages, so they still
+# overtake barriers
+QUICK_PRIORITY = 0
+
+
+class JobQueue(object):
+    """ Thread safe priority queue of (uid, command, packages) jobs.
+        Quick jobs (refresh) overtake long ones (system_upgrade), and
+        queued jobs can be withdrawn by uid. Transactions never overtake a
+        queued barrier (see BARRIERS). """
+
+    def __init__(self, on_dequeue=None):
+        # Called as on_dequeue(job, seconds waited) when a job leaves the queue
+        self.on_dequeue = on_dequeue
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+
+    def put(self, job):
+        uid, command, packages = job
+        priority = JOB_PRIORITIES.get(command, DEFAULT_PRIORITY)
+        with self._cond:
+            if priority > QUICK_PRIORITY:
+                for queued_priority, count, queued_at, queued_job in self._heap:
+                    if queued_job[1] in BARRIERS:
+                        priority = max(priority, queued_priority)
+            heapq.heappush(self._heap, (priority, next(self._counter), time.monotonic(), job))
+            self._cond.notify()
+
+    def get(self):
+        """ Removes and returns the next job, waiting if needed """
+        with self._cond:
+            while not self._heap:
+                self._cond.wait()
+            return self._pop()
+
+    def get_next_if(self, predicate):
+        """ Removes and returns the next job only if predicate(job) is
+            True. Never blocks; returns None otherwise. """
+        with self._cond:
+            if self._heap and predicate(self._heap[0][3]):
+                return self._pop()
+            return None
+
+    def _pop(self):
+        priority, count, queued_at, job = heapq.heappop(self._heap)
+        if self.on_dequeue is not None:
+            self.on_dequeue(job, time.monotonic() - queued_at)
+        return job
+
+    def remove(self, uid):
+        """ Withdraws a queued job. Returns True if it was found """
+        with self._cond:
+            for i, (priority, count, queued_at, job) in enumerate(self._heap):
+                if job[0] == uid:
+                    self._heap.pop(i)
+                    heapq.heapify(self._heap)
+                    return True
+            return False
+
+    def qsize(self):
+        with self._cond:
+            return len(self._heap)
+
+    def empty(self):
+        return self.qsize() == 0
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  metrics.py
+#
+#  Copyright © 2015-2017 Antergos
+#
+#  This file is part of antergos-welcome
+#
+#  Antergos-welcome is free software: you can redistribute it and/or modify
+#  it under the temms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Antergos-welcome is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Antergos-welcome. If not, see <http://www.gnu.org/licenses/>.
+
+""" Counters and histograms of the daemon, in Prometheus text format """
+
+import bisect
+import logging
+import os
+import threading
+
+# Upper bounds (seconds) of latency histograms
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+# Upper bounds (seconds) of job durations
+DURATION_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600)
+# Upper bounds (bytes/s) of download speeds
+THROUGHPUT_BUCKETS = (16e3, 64e3, 256e3, 1e6, 4e6, 16e6, 64e6)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(key, value) for key, value in labels) + "}"
+
+
+class Histogram(object):
+    """ Counts observations in cumulative buckets (like Prometheus) """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            yield (name + "_bucket" + _format_labels(labels + (('le', bound),)),
+                   cumulative)
+        yield name + "_sum" + _format_labels(labels), self.sum
+        yield name + "_count" + _format_labels(labels), self.count
+
+
+class Metrics(object):
+    """ Registry of counters, gauges and histograms. Every update is a dict
+        lookup and an addition under a lock, cheap enough to be always on.
+        Gauges can also be callables, read when the metrics are collected. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> (type, help)
+        self._info = {}
+        # name -> {labels: value or Histogram}
+        self._values = {}
+
+    def _declare(self, name, metric_type, help_text):
+        if name not in self._info:
+            self._info[name] = (metric_type, help_text)
+            self._values[name] = {}
+
+    def counter(self, name, help_text):
+        with self._lock:
+            self._declare(name, 'counter', help_text)
+
+    def gauge(self, name, help_text, callback=None):
+        """ callback() returns the current value, if given """
+        with self._lock:
+            self._declare(name, 'gauge', help_text)
+            if callback is not None:
+                self._values[name][()] = callback
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        with self._lock:
+            self._declare(name, 'histogram', help_text)
+            self._values[name][None] = buckets
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values[name]
+            values[key] = values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values[name]
+            histogram = values.get(key)
+            if histogram is None:
+                histogram = values[key] = Histogram(values[None])
+            histogram.observe(value)
+
+    def samples(self):
+        """ Returns a list of (name, sample name with labels, value) """
+        samples = []
+        with self._lock:
+            for name, values in self._values.items():
+                for labels, value in values.items():
+                    if labels is None:
+                        # Buckets of the histogram
+                        continue
+                    if isinstance(value, Histogram):
+                        samples.extend((name, sample, sample_value)
+                                       for sample, sample_value in value.samples(name, labels))
+                    else:
+                        samples.append((name, name + _format_labels(labels), value))
+        # Gauge callbacks are called without holding the lock
+        result = []
+        for name, sample, value in samples:
+            if callable(value):
+                try:
+                    value = value()
+                except Exception as err:
+                    logging.debug("Cannot read %s: %s", name, err)
+                    continue
+            result.append((name, sample, float(value)))
+        return result
+
+    def to_dict(self):
+        """ sample -> value (what get_metrics returns) """
+        return dict((sample, value) for name, sample, value in self.samples())
+
+    def to_text(self):
+        """ Prometheus text exposition format """
+        by_name = {}
+        for name, sample, value in self.samples():
+            by_name.setdefault(name, []).append((sample, value))
+        lines = []
+        for name in sorted(by_name):
+            metric_type, help_text = self._info[name]
+            lines.append("# HELP {0} {1}".format(name, help_text))
+            lines.append("# TYPE {0} {1}".format(name, metric_type))
+            for sample, value in by_name[name]:
+                lines.append("{0} {1}".format(sample, repr(value)))
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """ Writes the metrics for node_exporter's textfile collector. The
+            file is replaced atomically so it is never read half written.
+            Always returns True (it is used as a GLib timeout callback). """
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, 'w') as textfile:
+                textfile.write(self.to_text())
+            os.replace(tmp_path, path)
+        except OSError as err:
+            logging.warning("Cannot write metrics to %s: %s", path, err)
+        return True
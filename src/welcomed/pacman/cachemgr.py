@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  cachemgr.py
+#
+#  Copyright © 2015-2017 Antergos
+#
+#  This file is part of antergos-welcome
+#
+#  Antergos-welcome is free software: you can redistribute it and/or modify
+#  it under the temms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Antergos-welcome is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Antergos-welcome. If not, see <http://www.gnu.org/licenses/>.
+
+""" Package cache (CacheDir) cleaning, like paccache but size based """
+
+import functools
+import logging
+import os
+
+PKG_EXTENSIONS = ('.pkg.tar', '.pkg.tar.xz', '.pkg.tar.gz', '.pkg.tar.bz2', '.pkg.tar.zst')
+
+
+def parse_pkg_filename(filename):
+    """ Returns (name, version, arch) for name-pkgver-pkgrel-arch.pkg.tar.*
+        or None if filename is not a package """
+    for ext in PKG_EXTENSIONS:
+        if filename.endswith(ext):
+            base = filename[:-len(ext)]
+            break
+    else:
+        return None
+    parts = base.rsplit('-', 3)
+    if len(parts) != 4:
+        return None
+    name, pkgver, pkgrel, arch = parts
+    return name, "{0}-{1}".format(pkgver, pkgrel), arch
+
+
+class CachedPackage(object):
+    """ A package file in the cache (and its signature, if any) """
+
+    def __init__(self, path, name, version, size, last_used):
+        self.path = path
+        self.name = name
+        self.version = version
+        self.size = size
+        self.last_used = last_used
+
+
+class CacheManager(object):
+    """ Keeps the keep_versions most recent versions of each package,
+        every installed one and, if vercmp is given, every version newer
+        than the installed one (pending upgrades, maybe prefetched). Then,
+        if the cache is still bigger than max_bytes, removes the least
+        recently used packages that are not kept until it fits.
+
+        A package is used when it is read (atime) or arrives in the cache
+        (ctime). mtime is not used: downloads get the server's
+        Last-Modified as mtime (and atime).
+
+        Only stat() is used, files are never read. """
+
+    def __init__(self, cachedirs, keep_versions=3, max_bytes=None, vercmp=None):
+        self.cachedirs = cachedirs
+        self.keep_versions = keep_versions
+        self.max_bytes = max_bytes
+        # Used to sort versions (pyalpm.vercmp). If None, newest file wins.
+        self.vercmp = vercmp
+
+    def scan(self):
+        """ Returns a dict name -> list of CachedPackage """
+        packages = {}
+        for cachedir in self.cachedirs:
+            try:
+                entries = list(os.scandir(cachedir))
+            except OSError as err:
+                logging.warning("Cannot read %s: %s", cachedir, err)
+                continue
+            for entry in entries:
+                parsed = parse_pkg_filename(entry.name)
+                if parsed is None or not entry.is_file(follow_symlinks=False):
+                    continue
+                name, version, arch = parsed
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                size = st.st_size
+                sig_path = entry.path + ".sig"
+                if os.path.exists(sig_path):
+                    size += os.path.getsize(sig_path)
+                packages.setdefault(name, []).append(CachedPackage(
+                    entry.path, name, version, size, max(st.st_atime, st.st_ctime)))
+        return packages
+
+    def _sort_versions(self, pkgs):
+        """ Newest first """
+        if self.vercmp is None:
+            return sorted(pkgs, key=lambda pkg: pkg.last_used, reverse=True)
+        return sorted(pkgs, reverse=True, key=functools.cmp_to_key(
+            lambda a, b: self.vercmp(a.version, b.version)))
+
+    def _is_pinned(self, pkg, installed_version):
+        """ True if pkg is never removed: it is installed or, if versions
+            can be compared, it is newer than the installed one """
+        if installed_version is None:
+            return False
+        if installed_version == pkg.version:
+            return True
+        return self.vercmp is not None and self.vercmp(pkg.version, installed_version) > 0
+
+    def get_evictions(self, installed):
+        """ installed is a dict name -> installed version.
+            Returns (list of CachedPackage to remove, bytes kept) """
+        evict = []
+        candidates = []
+        kept_bytes = 0
+        for name, pkgs in self.scan().items():
+            for i, pkg in enumerate(self._sort_versions(pkgs)):
+                if self._is_pinned(pkg, installed.get(name)):
+                    # What the local db references, or the next upgrade
+                    kept_bytes += pkg.size
+                elif i < self.keep_versions:
+                    candidates.append(pkg)
+                    kept_bytes += pkg.size
+                else:
+                    evict.append(pkg)
+
+        if self.max_bytes is not None and kept_bytes > self.max_bytes:
+            # Least recently used first
+            candidates.sort(key=lambda pkg: pkg.last_used)
+            for pkg in candidates:
+                if kept_bytes <= self.max_bytes:
+                    break
+                evict.append(pkg)
+                kept_bytes -= pkg.size
+        return evict, kept_bytes
+
+    def clean(self, installed, dry_run=False):
+        """ Removes old packages. Returns (list of removed files, bytes freed) """
+        evict, kept_bytes = self.get_evictions(installed)
+        removed = []
+        freed = 0
+        for pkg in evict:
+            if not dry_run:
+                try:
+                    os.unlink(pkg.path)
+                    if os.path.exists(pkg.path + ".sig"):
+                        os.unlink(pkg.path + ".sig")
+                except OSError as err:
+                    logging.warning("Cannot remove %s: %s", pkg.path, err)
+                    continue
+            removed.append(os.path.basename(pkg.path))
+            freed += pkg.size
+        logging.info("Package cache: %d files removed (%d bytes freed, %d bytes kept)",
+                     len(removed), freed, kept_bytes)
+        return removed, freed
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  catalog.py
+#
+#  Copyright © 2015-2017 Antergos
+#
+#  This file is part of antergos-welcome
+#
+#  Antergos-welcome is free software: you can redistribute it and/or modify
+#  it under the temms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Antergos-welcome is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Antergos-welcome. If not, see <http://www.gnu.org/licenses/>.
+
+""" On-disk snapshot of the sync package catalog (get_packages_info output) """
+
+import json
+import logging
+import os
+
+_DEFAULT_SNAPSHOT_PATH = "/var/cache/antergos-welcomed/catalog.json"
+
+SNAPSHOT_VERSION = 1
+
+
+class CatalogSnapshot(object):
+    """ Stores the package catalog on disk, keyed by the mtime and size of
+        each sync db file. If any of them changes (refresh), the snapshot
+        is considered stale and load() returns None. """
+
+    def __init__(self, db_path, repos, path=_DEFAULT_SNAPSHOT_PATH):
+        self.sync_path = os.path.join(db_path, "sync")
+        self.repos = list(repos)
+        self.path = path
+
+    def get_key(self):
+        """ Returns {repo: [mtime, size]} for each sync db file """
+        key = {}
+        for repo in self.repos:
+            db_file = os.path.join(self.sync_path, "{}.db".format(repo))
+            try:
+                st = os.stat(db_file)
+                key[repo] = [st.st_mtime_ns, st.st_size]
+            except OSError:
+                key[repo] = None
+        return key
+
+    def load(self):
+        """ Returns the stored catalog or None if missing or stale """
+        try:
+            with open(self.path) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except (OSError, ValueError) as err:
+            logging.debug("Cannot read catalog snapshot: %s", err)
+            return None
+
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            return None
+        if snapshot.get('key') != self.get_key():
+            logging.debug("Catalog snapshot is stale")
+            return None
+        return snapshot.get('packages')
+
+    def save(self, packages, key=None):
+        """ Writes the catalog atomically. key must be the get_key() taken
+            before packages were read (current one if None). """
+        snapshot = {
+            'version': SNAPSHOT_VERSION,
+            'key': key if key is not None else self.get_key(),
+            'packages': packages}
+        tmp_path = self.path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, 'w') as snapshot_file:
+                json.dump(snapshot, snapshot_file, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+        except (OSError, TypeError, ValueError) as err:
+            logging.warning("Cannot write catalog snapshot: %s", err)
+            return False
+        return True
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  dbsync.py
+#
+#  Copyright © 2015-2017 Antergos
+#
+#  This file is part of antergos-welcome
+#
+#  Antergos-welcome is free software: you can redistribute it and/or modify
+#  it under the temms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Antergos-welcome is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Antergos-welcome. If not, see <http://www.gnu.org/licenses/>.
+
+""" Concurrent download of the sync databases (pacman -Sy) """
+
+import email.utils
+import json
+import logging
+import os
+import urllib.error
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# If we are importing this module from backend:
+try:
+    import hedge as hedge
+except ImportError:
+    import pacman.hedge as hedge
+
+_DEFAULT_STATE_PATH = "/var/cache/antergos-welcomed/dbsync.json"
+
+# Result of each repo
+FETCHED = 'fetched'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+
+class DatabaseSync(object):
+    """ Downloads the .db (and .db.sig, if present) file of several repos at
+        the same time, using a bounded pool of threads. Files are downloaded
+        next to the current ones and are only moved in place (os.replace)
+        once every download has finished, so libalpm never sees a partial
+        database.
+
+        Unless forced, a repo checked less than min_age seconds ago is not
+        even asked, and the others are asked with If-Modified-Since and
+        If-None-Match (ETag) so unchanged databases are not downloaded.
+        ETags are only sent to the server that gave them: a mirror doesn't
+        know another's ETag and would send the whole database.
+        min_age can be a number or a dict repo -> seconds ('default' key
+        for the rest).
+
+        If the cancelled token (hedge.CancelToken) is set, downloads stop
+        and no database is replaced. """
+
+    def __init__(self, sync_path, max_workers=4, timeout=30, min_age=0,
+                 state_path=_DEFAULT_STATE_PATH, transfer_callback=None, hedge_delay=3,
+                 cancelled=None):
+        self.sync_path = sync_path
+        self.cancelled = cancelled if cancelled is not None else hedge.CancelToken()
+        # Seconds without receiving a byte before asking the next server too
+        # (0 tries them one after the other)
+        self.hedge_delay = hedge_delay
+        self._hedge_executor = None
+        # Called as transfer_callback(url, nbytes, seconds, ok) after each download
+        self.transfer_callback = transfer_callback
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.min_age = min_age
+        self.state_path = state_path
+        # repo -> {'checked': time of last check, 'etags': {server netloc: ETag}}
+        self.state = self._load_state()
+
+    def _load_state(self):
+        if not self.state_path:
+            return {}
+        try:
+            with open(self.state_path) as state_file:
+                return json.load(state_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self):
+        if not self.state_path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            with open(self.state_path, 'w') as state_file:
+                json.dump(self.state, state_file)
+        except OSError as err:
+            logging.warning("Cannot save %s: %s", self.state_path, err)
+
+    def get_min_age(self, repo):
+        if isinstance(self.min_age, dict):
+            return self.min_age.get(repo, self.min_age.get('default', 0))
+        return self.min_age
+
+    def is_fresh(self, repo):
+        """ True if repo has been checked less than min_age seconds ago """
+        checked = self.state.get(repo, {}).get('checked')
+        if checked is None or not os.path.exists(self._db_file(repo)):
+            return False
+        return time.time() - checked < self.get_min_age(repo)
+
+    def _db_file(self, repo, ext=".db"):
+        return os.path.join(self.sync_path, repo + ext)
+
+    def _tmp_file(self, repo, ext=".db"):
+        return os.path.join(self.sync_path, ".{0}{1}.part".format(repo, ext))
+
+    def _request(self, url, repo, force):
+        """ Builds the request for url. Not forced requests are conditional,
+            so unchanged databases are not downloaded again. """
+        request = urllib.request.Request(url)
+        db_file = self._db_file(repo)
+        if not force and os.path.exists(db_file):
+            request.add_header(
+                'If-Modified-Since',
+                email.utils.formatdate(os.path.getmtime(db_file), usegmt=True))
+            etags = self.state.get(repo, {}).get('etags', {})
+            etag = etags.get(urllib.parse.urlsplit(url).netloc)
+            if etag:
+                request.add_header('If-None-Match', etag)
+        return request
+
+    def _download(self, url, dest, request, started=None, cancelled=None):
+        """ Downloads url to dest. Returns the response headers, or None
+            if not modified. started is set when the first byte arrives; the
+            download stops (HedgeCancelled) as soon as cancelled is set. """
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                with open(dest, 'wb') as dest_file:
+                    while True:
+                        if cancelled is not None and cancelled.is_set():
+                            raise hedge.HedgeCancelled(url)
+                        chunk = response.read(64 * 1024)
+                        if not chunk:
+                            break
+                        if started is not None:
+                            started.set()
+                        dest_file.write(chunk)
+                headers = response.headers
+        except urllib.error.HTTPError as err:
+            if err.code == 304:
+                return None
+            raise
+        last_modified = headers.get('Last-Modified')
+        if last_modified:
+            # Keep server's mtime, as libalpm does
+            try:
+                mtime = email.utils.parsedate_to_datetime(last_modified).timestamp()
+                os.utime(dest, (mtime, mtime))
+            except (TypeError, ValueError):
+                pass
+        return headers
+
+    def _fetch_repo(self, repo, servers, force):
+        """ Downloads the repo database from its first server. If it does not
+            answer within hedge_delay seconds (or fails), the next server is
+            asked too and the first one to finish wins.
+            Returns (result, ETags of the database by server netloc) """
+        tmp_file = self._tmp_file(repo)
+
+        def attempt(server, index, started, lost):
+            url = "{0}/{1}.db".format(server.rstrip('/'), repo)
+            path = self._tmp_file(repo, ".db.h{}".format(index))
+            start_time = time.monotonic()
+            # Cancelling the sync stops every attempt
+            self.cancelled.add_callback(lost.set)
+            try:
+                headers = self._download(
+                    url, path, self._request(url, repo, force), started, lost)
+            except (urllib.error.URLError, OSError) as err:
+                logging.warning("Cannot download %s: %s", url, err)
+                self._record(url, 0, start_time, False)
+                raise
+            except hedge.HedgeCancelled:
+                # Lost the race. A server that sent nothing counts as a
+                # failure, a slow one as a slow transfer.
+                try:
+                    nbytes = os.path.getsize(path)
+                    os.unlink(path)
+                except OSError:
+                    nbytes = 0
+                if not self.cancelled.is_set():
+                    self._record(url, nbytes, start_time, nbytes > 0)
+                raise
+            finally:
+                self.cancelled.remove_callback(lost.set)
+            if headers is None:
+                self._record(url, 0, start_time, True)
+            else:
+                self._record(url, os.path.getsize(path), start_time, True)
+            return path, headers
+
+        def discard(index, result):
+            path, headers = result
+            if headers is not None and os.path.exists(path):
+                os.unlink(path)
+
+        if not servers or self.cancelled.is_set():
+            return FAILED, None
+        delay = self.hedge_delay if self.hedge_delay > 0 else None
+        try:
+            index, (path, headers) = hedge.run_hedged(
+                attempt, servers, delay, self._hedge_executor, discard)
+        except (urllib.error.URLError, OSError, hedge.HedgeCancelled):
+            logging.error("Cannot download %s database from any server", repo)
+            return FAILED, None
+
+        if headers is None:
+            logging.debug("%s is up to date", repo)
+            return SKIPPED, self.state.get(repo, {}).get('etags', {})
+        os.replace(path, tmp_file)
+
+        # Signature is optional (depends on SigLevel)
+        url = "{0}/{1}.db".format(servers[index].rstrip('/'), repo)
+        try:
+            self._download(url + ".sig", self._tmp_file(repo, ".db.sig"),
+                           urllib.request.Request(url + ".sig"))
+        except (urllib.error.URLError, OSError):
+            pass
+        logging.debug("%s downloaded from %s", repo, servers[index])
+        # ETags of other servers are for the old database
+        etag = headers.get('ETag')
+        return FETCHED, {urllib.parse.urlsplit(url).netloc: etag} if etag else {}
+
+    def _record(self, url, nbytes, start_time, ok):
+        if self.transfer_callback is not None:
+            self.transfer_callback(url, nbytes, time.monotonic() - start_time, ok)
+
+    def sync(self, repos, force=False):
+        """ repos is a dict repo name -> list of servers (already expanded).
+            Returns a dict repo name -> FETCHED, SKIPPED or FAILED """
+        results = {}
+        to_fetch = {}
+        for repo, servers in repos.items():
+            if not force and self.is_fresh(repo):
+                logging.debug("%s was checked recently, skipping it", repo)
+                results[repo] = SKIPPED
+            else:
+                to_fetch[repo] = servers
+
+        if to_fetch:
+            workers = max(1, min(self.max_workers, len(to_fetch)))
+            now = time.time()
+            # Hedged attempts run in their own pool. Slow attempts that lost
+            # the race are not waited for.
+            self._hedge_executor = ThreadPoolExecutor(max_workers=2 * workers)
+            try:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    futures = dict(
+                        (repo, executor.submit(self._fetch_repo, repo, servers, force))
+                        for repo, servers in to_fetch.items())
+                    outcomes = dict((repo, future.result())
+                                    for repo, future in futures.items())
+            finally:
+                self._hedge_executor.shutdown(wait=False)
+                self._hedge_executor = None
+            cancelled = self.cancelled.is_set()
+            for repo, (result, etags) in outcomes.items():
+                if cancelled and result == FETCHED:
+                    # Downloaded but not moved in place
+                    result = FAILED
+                results[repo] = result
+                if result != FAILED:
+                    self.state[repo] = {'checked': now, 'etags': etags}
+            self._save_state()
+            if cancelled:
+                logging.info("Database sync cancelled")
+                self._clean()
+                return results
+
+        # Everything has been downloaded, move new files in place
+        for repo, result in results.items():
+            if result != FETCHED:
+                continue
+            os.replace(self._tmp_file(repo), self._db_file(repo))
+            if os.path.exists(self._tmp_file(repo, ".db.sig")):
+                os.replace(self._tmp_file(repo, ".db.sig"), self._db_file(repo, ".db.sig"))
+            elif os.path.exists(self._db_file(repo, ".db.sig")):
+                # Old signature does not match the new database
+                os.unlink(self._db_file(repo, ".db.sig"))
+        self._clean()
+        return results
+
+    def _clean(self):
+        """ Removes leftovers of failed downloads """
+        for name in os.listdir(self.sync_path):
+            if name.startswith('.') and name.endswith('.part'):
+                try:
+                    os.unlink(os.path.join(self.sync_path, name))
+                except OSError:
+                    pass
@@ -0,0 +1,519 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  fetch.py
+#
+#  Copyright © 2015-2017 Antergos
+#
+#  This file is part of antergos-welcome
+#
+#  Antergos-welcome is free software: you can redistribute it and/or modify
+#  it under the temms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Antergos-welcome is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Antergos-welcome. If not, see <http://www.gnu.org/licenses/>.
+
+""" Package download engine (used as libalpm's fetch callback) """
+
+import email.utils
+import http.client
+import logging
+import os
+import socket
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+# If we are importing this module from backend:
+try:
+    import hedge as hedge
+except ImportError:
+    import pacman.hedge as hedge
+
+# Values returned to libalpm by the fetch callback
+FETCH_OK = 0
+FETCH_UP_TO_DATE = 1
+FETCH_ERROR = -1
+
+CHUNK_SIZE = 64 * 1024
+
+
+class FetchError(Exception):
+    """ Download failed """
+    pass
+
+
+class FetchCancelled(FetchError):
+    """ Download interrupted by FetchEngine.cancel() """
+    pass
+
+
+class FetchEngine(object):
+    """ Downloads files over persistent (keep-alive) HTTP connections, one
+        per mirror and worker thread. file:// urls are copied, and other
+        schemes (ftp) or urls that must go through a proxy (http_proxy and
+        friends) are downloaded with urllib.
+
+        fetch() has the signature libalpm expects for handle.fetchcb, and is
+        used for single files (databases, signatures, anything not already
+        downloaded). download_many() downloads a whole transaction with a
+        bounded pool of threads before libalpm asks for the files, so they
+        are found in the cache when the transaction is committed. """
+
+    def __init__(self, max_workers=4, timeout=30, progress_callback=None,
+                 transfer_callback=None, hedge_delay=3, dl_callback=None):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        # Seconds without receiving a byte before asking the next mirror too
+        # (0 disables hedged requests)
+        self.hedge_delay = hedge_delay
+        # Server lists (one per repo) used to find alternatives of an url
+        self.server_lists = []
+        # Called as progress_callback(filename, done_bytes, total_bytes, finished_files)
+        self.progress_callback = progress_callback
+        # Called as transfer_callback(url, nbytes, seconds, ok) after each download
+        self.transfer_callback = transfer_callback
+        # Called as dl_callback(filename, transferred, total) while fetch()
+        # downloads a file (libalpm doesn't call dlcb when fetchcb is set)
+        self.dl_callback = dl_callback
+        # Set by cancel(): running downloads stop, pending ones don't start
+        self.cancelled = hedge.CancelToken()
+        self._local = threading.local()
+        # Threads (and their connections) are kept between downloads
+        self._executor = None
+        self._hedge_executor = None
+        self._progress_lock = threading.Lock()
+        self._done_bytes = 0
+        self._total_bytes = 0
+        self._finished = 0
+
+    def _get_connection(self, scheme, netloc):
+        """ Returns this thread's connection to netloc (reused if possible) """
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        conn = connections.get((scheme, netloc))
+        if conn is None:
+            if scheme == 'https':
+                conn = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+            connections[(scheme, netloc)] = conn
+        return conn
+
+    def _drop_connection(self, scheme, netloc):
+        connections = getattr(self._local, 'connections', {})
+        conn = connections.pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+    @staticmethod
+    def _use_proxy(parts):
+        """ True if urllib would send this url through a proxy """
+        proxies = urllib.request.getproxies()
+        return (parts.scheme in proxies and
+                not urllib.request.proxy_bypass(parts.hostname or ''))
+
+    @staticmethod
+    def _set_mtime(dest, last_modified):
+        """ Keeps server's mtime (used in the next If-Modified-Since) """
+        if last_modified:
+            try:
+                mtime = email.utils.parsedate_to_datetime(last_modified).timestamp()
+                os.utime(dest, (mtime, mtime))
+            except (TypeError, ValueError):
+                pass
+
+    def _copy(self, url, source, dest, on_data, total, started, cancelled):
+        """ Copies file object source to dest (through dest.part) """
+        tmp_file = dest + ".part"
+        try:
+            with open(tmp_file, 'wb') as dest_file:
+                while True:
+                    if cancelled is not None and cancelled.is_set():
+                        raise hedge.HedgeCancelled(url)
+                    chunk = source.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if started is not None:
+                        started.set()
+                    dest_file.write(chunk)
+                    if on_data is not None:
+                        on_data(len(chunk), total)
+        except hedge.HedgeCancelled:
+            self._remove(tmp_file)
+            raise
+        except (http.client.HTTPException, OSError) as err:
+            self._remove(tmp_file)
+            raise FetchError("{0}: {1}".format(url, err))
+        os.replace(tmp_file, dest)
+
+    def _get_file(self, url, dest, on_data, if_modified_since, started, cancelled):
+        """ _get for file:// urls (local repositories) """
+        path = urllib.request.url2pathname(urllib.parse.urlsplit(url).path)
+        try:
+            mtime = os.path.getmtime(path)
+            if if_modified_since is not None and int(mtime) <= int(if_modified_since):
+                return False
+            with open(path, 'rb') as source:
+                total = os.fstat(source.fileno()).st_size
+                self._copy(url, source, dest, on_data, total, started, cancelled)
+        except OSError as err:
+            raise FetchError("{0}: {1}".format(url, err))
+        os.utime(dest, (mtime, mtime))
+        return True
+
+    def _get_urllib(self, url, dest, on_data, if_modified_since, started, cancelled):
+        """ _get for ftp:// and proxied urls """
+        request = urllib.request.Request(url)
+        if if_modified_since is not None:
+            request.add_header('If-Modified-Since', email.utils.formatdate(
+                if_modified_since, usegmt=True))
+        try:
+            response = urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as err:
+            err.close()
+            if err.code == 304:
+                return False
+            raise FetchError("{0}: HTTP {1}".format(url, err.code))
+        except (urllib.error.URLError, http.client.HTTPException, OSError,
+                ValueError) as err:
+            raise FetchError("{0}: {1}".format(url, err))
+        with response:
+            try:
+                total = int(response.headers.get('Content-Length') or 0)
+            except ValueError:
+                total = 0
+            self._copy(url, response, dest, on_data, total, started, cancelled)
+            self._set_mtime(dest, response.headers.get('Last-Modified'))
+        return True
+
+    def _get(self, url, dest, on_data=None, redirects=5, if_modified_since=None,
+             started=None, cancelled=None):
+        """ Downloads url to dest (through dest.part). Returns False if the
+            file has not been modified since if_modified_since (timestamp).
+            on_data(size, total) is called as data arrives (total is 0 if
+            unknown). started is set when the first byte arrives; the
+            download stops (HedgeCancelled) as soon as cancelled is set. """
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme == 'file':
+            return self._get_file(url, dest, on_data, if_modified_since,
+                                  started, cancelled)
+        if parts.scheme not in ('http', 'https') or self._use_proxy(parts):
+            return self._get_urllib(url, dest, on_data, if_modified_since,
+                                    started, cancelled)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = {'Connection': 'keep-alive'}
+        if if_modified_since is not None:
+            headers['If-Modified-Since'] = email.utils.formatdate(
+                if_modified_since, usegmt=True)
+
+        for attempt in range(2):
+            conn = self._get_connection(parts.scheme, parts.netloc)
+            abort = None
+            if cancelled is not None:
+                # Unblock the socket if another mirror wins meanwhile
+                abort = lambda: self._abort(conn)
+                cancelled.add_callback(abort)
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                break
+            except (http.client.HTTPException, OSError) as err:
+                self._drop_connection(parts.scheme, parts.netloc)
+                if cancelled is not None and cancelled.is_set():
+                    raise hedge.HedgeCancelled(url)
+                # Server may have closed the kept alive connection. Retry once.
+                if attempt > 0:
+                    raise FetchError("{0}: {1}".format(url, err))
+            finally:
+                if abort is not None:
+                    cancelled.remove_callback(abort)
+
+        if response.status in (301, 302, 303, 307, 308) and redirects > 0:
+            location = response.getheader('Location')
+            response.read()
+            return self._get(urllib.parse.urljoin(url, location), dest, on_data,
+                             redirects - 1, if_modified_since, started, cancelled)
+        if response.status == 304:
+            response.read()
+            return False
+        if response.status != 200:
+            response.read()
+            raise FetchError("{0}: HTTP {1}".format(url, response.status))
+
+        try:
+            total = int(response.getheader('Content-Length') or 0)
+        except ValueError:
+            total = 0
+        tmp_file = dest + ".part"
+        abort = None
+        if cancelled is not None:
+            abort = lambda: self._abort(conn)
+            cancelled.add_callback(abort)
+        try:
+            with open(tmp_file, 'wb') as dest_file:
+                while True:
+                    if cancelled is not None and cancelled.is_set():
+                        raise hedge.HedgeCancelled(url)
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if started is not None:
+                        started.set()
+                    dest_file.write(chunk)
+                    if on_data is not None:
+                        on_data(len(chunk), total)
+        except hedge.HedgeCancelled:
+            self._drop_connection(parts.scheme, parts.netloc)
+            self._remove(tmp_file)
+            raise
+        except (http.client.HTTPException, OSError) as err:
+            self._drop_connection(parts.scheme, parts.netloc)
+            self._remove(tmp_file)
+            if cancelled is not None and cancelled.is_set():
+                raise hedge.HedgeCancelled(url)
+            raise FetchError("{0}: {1}".format(url, err))
+        finally:
+            if abort is not None:
+                cancelled.remove_callback(abort)
+        if response.will_close:
+            self._drop_connection(parts.scheme, parts.netloc)
+        os.replace(tmp_file, dest)
+        self._set_mtime(dest, response.getheader('Last-Modified'))
+        return True
+
+    @staticmethod
+    def _abort(conn):
+        """ Makes a blocked read on conn fail (called from another thread) """
+        if conn.sock is not None:
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def _timed_get(self, url, dest, on_data=None, if_modified_since=None,
+                   started=None, cancelled=None):
+        """ Same as _get, telling transfer_callback how it went """
+        start_time = time.monotonic()
+        received = {'bytes': 0}
+
+        def on_attempt_data(size, total):
+            received['bytes'] += size
+            if on_data is not None:
+                on_data(size, total)
+
+        try:
+            modified = self._get(url, dest, on_attempt_data,
+                                 if_modified_since=if_modified_since,
+                                 started=started, cancelled=cancelled)
+        except FetchError:
+            if self.transfer_callback is not None:
+                self.transfer_callback(url, 0, time.monotonic() - start_time, False)
+            raise
+        except hedge.HedgeCancelled:
+            # Lost the race. A mirror that sent nothing counts as a failure,
+            # a slow one as a slow transfer. Not if we were cancelled.
+            if self.transfer_callback is not None and not self.cancelled.is_set():
+                self.transfer_callback(url, received['bytes'], time.monotonic() - start_time,
+                                       received['bytes'] > 0)
+            raise
+        if self.transfer_callback is not None:
+            nbytes = os.path.getsize(dest) if modified else 0
+            self.transfer_callback(url, nbytes, time.monotonic() - start_time, True)
+        return modified
+
+    def _hedged_get(self, urls, dest, on_data=None, if_modified_since=None):
+        """ Downloads dest from the first url. If it hasn't sent anything
+            after hedge_delay seconds, the next url is tried at the same time,
+            and so on. The first one to finish wins. Returns False if not
+            modified. Raises FetchCancelled if cancel() is called. """
+        cancelled = self.cancelled
+        if cancelled.is_set():
+            raise FetchCancelled(urls[0])
+        if self.hedge_delay <= 0 or len(urls) == 1:
+            error = None
+            for url in urls:
+                try:
+                    return self._timed_get(url, dest, on_data, if_modified_since,
+                                           cancelled=cancelled)
+                except hedge.HedgeCancelled:
+                    raise FetchCancelled(url)
+                except FetchError as err:
+                    logging.warning("Cannot download %s", err)
+                    error = err
+            raise error
+
+        # Only the first attempt to receive data reports progress
+        lock = threading.Lock()
+        leader = {'index': None}
+
+        def attempt(url, index, started, lost):
+            def on_attempt_data(size, total):
+                with lock:
+                    if leader['index'] is None:
+                        leader['index'] = index
+                if leader['index'] == index and on_data is not None:
+                    on_data(size, total)
+            path = "{0}.h{1}".format(dest, index)
+            # cancel() stops every attempt
+            cancelled.add_callback(lost.set)
+            try:
+                if self._timed_get(url, path, on_attempt_data, if_modified_since,
+                                   started, lost):
+                    return path
+                return None
+            finally:
+                cancelled.remove_callback(lost.set)
+
+        def discard(index, path):
+            if path is not None:
+                self._remove(path)
+
+        if self._hedge_executor is None:
+            self._hedge_executor = ThreadPoolExecutor(
+                max_workers=max(2, 2 * self.max_workers))
+        try:
+            index, path = hedge.run_hedged(
+                attempt, urls, self.hedge_delay, self._hedge_executor, discard)
+        except hedge.HedgeCancelled:
+            raise FetchCancelled(urls[0])
+        if cancelled.is_set():
+            # Cancelled right after the winner finished
+            discard(index, path)
+            raise FetchCancelled(urls[index])
+        if index > 0:
+            logging.debug("%s: hedged request won", urls[index])
+        if path is None:
+            return False
+        os.replace(path, dest)
+        return True
+
+    def get_alternatives(self, url):
+        """ Returns url followed by the same file in the other servers of its repo """
+        for servers in self.server_lists:
+            for server in servers:
+                prefix = server.rstrip('/') + '/'
+                if url.startswith(prefix):
+                    filename = url[len(prefix):]
+                    return [url] + [other.rstrip('/') + '/' + filename
+                                    for other in servers if other != server]
+        return [url]
+
+    def fetch(self, url, localpath, force):
+        """ libalpm fetch callback. localpath is the destination directory """
+        dest = os.path.join(localpath, os.path.basename(urllib.parse.urlsplit(url).path))
+        if_modified_since = None
+        if not force and os.path.exists(dest):
+            if_modified_since = os.path.getmtime(dest)
+
+        filename = os.path.basename(dest)
+        transferred = {'bytes': 0}
+
+        def on_data(size, total):
+            if self.dl_callback is None:
+                return
+            if transferred['bytes'] == 0:
+                # Tells dlcb that a new file is coming
+                self.dl_callback(filename, 0, total)
+            transferred['bytes'] += size
+            self.dl_callback(filename, transferred['bytes'], total)
+
+        try:
+            if not self._hedged_get(self.get_alternatives(url), dest, on_data,
+                                    if_modified_since):
+                return FETCH_UP_TO_DATE
+        except FetchError as err:
+            logging.warning("Cannot download %s", err)
+            return FETCH_ERROR
+        return FETCH_OK
+
+    def _on_data(self, filename, size):
+        with self._progress_lock:
+            self._done_bytes += size
+            done, total, finished = self._done_bytes, self._total_bytes, self._finished
+        if self.progress_callback is not None:
+            self.progress_callback(filename, done, total, finished)
+
+    def _download_one(self, filename, urls, dest_dir):
+        dest = os.path.join(dest_dir, filename)
+        try:
+            self._hedged_get(urls, dest, lambda size, total: self._on_data(filename, size))
+        except FetchCancelled:
+            return False
+        except FetchError as err:
+            logging.warning("Cannot download %s", err)
+            return False
+        with self._progress_lock:
+            self._finished += 1
+        return True
+
+    def download_many(self, files, dest_dir):
+        """ files is a list of (filename, [urls], size). Each file is tried
+            on its urls in order. Returns the list of filenames that could
+            not be downloaded. """
+        if not files:
+            return []
+        with self._progress_lock:
+            self._done_bytes = 0
+            self._total_bytes = sum(size for filename, urls, size in files)
+            self._finished = 0
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=max(1, self.max_workers))
+        futures = dict(
+            (filename, self._executor.submit(self._download_one, filename, urls, dest_dir))
+            for filename, urls, size in files)
+
+        def cancel_pending():
+            for future in futures.values():
+                future.cancel()
+
+        cancelled = self.cancelled
+        cancelled.add_callback(cancel_pending)
+        failed = []
+        try:
+            for filename, future in futures.items():
+                try:
+                    if not future.result():
+                        failed.append(filename)
+                except CancelledError:
+                    failed.append(filename)
+        finally:
+            cancelled.remove_callback(cancel_pending)
+        return failed
+
+    def cancel(self):
+        """ Stops running downloads and the ones not started yet (from any thread) """
+        self.cancelled.set()
+
+    def reset_cancel(self):
+        """ Allows downloads again after cancel() """
+        if self.cancelled.is_set():
+            self.cancelled = hedge.CancelToken()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        if self._hedge_executor is not None:
+            self._hedge_executor.shutdown(wait=False)
+            self._hedge_executor = None
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  hedge.py
+#
+#  Copyright © 2015-2017 Antergos
+#
+#  This file is part of antergos-welcome
+#
+#  Antergos-welcome is free software: you can redistribute it and/or modify
+#  it under the temms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Antergos-welcome is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Antergos-welcome. If not, see <http://www.gnu.org/licenses/>.
+
+""" Hedged requests: ask the next mirror if the current one is too slow """
+
+import queue
+import threading
+
+
+class HedgeCancelled(Exception):
+    """ Raised by an attempt that has lost the race """
+    pass
+
+
+class CancelToken(object):
+    """ Like threading.Event, but callbacks can be registered to abort
+        blocking operations (closing a socket) when it is set """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def is_set(self):
+        return self._event.is_set()
+
+    def set(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+
+    def add_callback(self, callback):
+        """ Calls callback when the token is set (now, if it already is) """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+
+def run_hedged(attempt, candidates, delay, executor, discard=None):
+    """ Runs attempt(candidate, index, started, cancelled) for candidates[0].
+        If no attempt has set the 'started' event (first byte received)
+        after delay seconds, or if an attempt fails, the next candidate is
+        started too. The first attempt that finishes wins: the others see
+        the 'cancelled' token (CancelToken) set and should stop as soon as
+        possible.
+        Results of attempts that finish after the winner are passed to
+        discard(index, result) so they can be cleaned up.
+
+        Returns (index, result) of the winner. If every candidate fails,
+        the last exception is raised. """
+    if not candidates:
+        raise ValueError("No candidates")
+
+    started = threading.Event()
+    cancelled = CancelToken()
+    outcomes = queue.Queue()
+    lock = threading.Lock()
+    state = {'winner': None}
+
+    def run(index):
+        try:
+            result = attempt(candidates[index], index, started, cancelled)
+        except Exception as err:
+            outcomes.put((index, False, err))
+            return
+        with lock:
+            won = state['winner'] is None
+            if won:
+                state['winner'] = index
+        if won:
+            cancelled.set()
+            outcomes.put((index, True, result))
+        elif discard is not None:
+            discard(index, result)
+
+    next_index = 0
+    running = 0
+    last_error = None
+
+    executor.submit(run, next_index)
+    next_index += 1
+    running += 1
+
+    while True:
+        can_hedge = next_index < len(candidates)
+        timeout = delay if (can_hedge and not started.is_set()) else None
+        try:
+            index, ok, result = outcomes.get(timeout=timeout)
+        except queue.Empty:
+            # Nothing received in time, ask the next one too
+            executor.submit(run, next_index)
+            next_index += 1
+            running += 1
+            continue
+
+        running -= 1
+        if ok:
+            return index, result
+        last_error = result
+        if next_index < len(candidates):
+            executor.submit(run, next_index)
+            next_index += 1
+            running += 1
+        elif running == 0:
+            raise last_error
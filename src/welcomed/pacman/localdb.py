@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  localdb.py
+#
+#  Copyright © 2015-2017 Antergos
+#
+#  This file is part of antergos-welcome
+#
+#  Antergos-welcome is free software: you can redistribute it and/or modify
+#  it under the temms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Antergos-welcome is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Antergos-welcome. If not, see <http://www.gnu.org/licenses/>.
+
+""" In-memory index of the local (installed) package database """
+
+import logging
+import os
+import threading
+
+try:
+    import pyalpm
+except ImportError as err:
+    logging.error(err)
+
+
+class LocalDbIndex(object):
+    """ Maps package name -> (version, reason, installed size) for every
+        installed package. The index is built from the handle's local db
+        the first time it is needed and is only rebuilt when it has been
+        invalidated (QueryHandles.invalidate, after one of our jobs) or
+        when the mtime of DBPath/local changes (someone else ran pacman).
+
+        libalpm reads the local db only once per handle, so the handle is
+        only used for the first build: rebuilds open a new one. If handle
+        is None, every build opens one. """
+
+    def __init__(self, handle, root_dir, db_path):
+        self.handle = handle
+        self.root_dir = root_dir
+        self.db_path = db_path
+        self.local_path = os.path.join(db_path, "local")
+        self._index = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        """ Forces a rebuild on next lookup """
+        with self._lock:
+            self._index = None
+
+    def is_warm(self):
+        """ True if the index is built and the local db has not changed since """
+        with self._lock:
+            index, mtime = self._index, self._mtime
+        return index is not None and mtime == self._get_mtime()
+
+    def is_stale(self):
+        """ True if the index is built but the local db has changed since """
+        with self._lock:
+            index, mtime = self._index, self._mtime
+        return index is not None and mtime != self._get_mtime()
+
+    def _get_mtime(self):
+        try:
+            return os.stat(self.local_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _rebuild(self, mtime):
+        handle = self.handle
+        if handle is None:
+            handle = pyalpm.Handle(self.root_dir, self.db_path)
+        self.handle = None
+        index = {}
+        for pkg in handle.get_localdb().pkgcache:
+            index[pkg.name] = (pkg.version, pkg.reason, pkg.isize)
+        self._index = index
+        self._mtime = mtime
+        logging.debug("Local db index rebuilt (%d packages)", len(index))
+
+    def _get_index(self):
+        mtime = self._get_mtime()
+        with self._lock:
+            if self._index is None or mtime != self._mtime:
+                self._rebuild(mtime)
+            return self._index
+
+    def get_versions(self, pkg_names):
+        """ Returns a dict name -> installed version ("" if not installed) """
+        index = self._get_index()
+        versions = {}
+        for name in pkg_names:
+            entry = index.get(name)
+            versions[name] = entry[0] if entry else ""
+        return versions
+
+    def items(self):
+        return self._get_index().items()
+
+    def __contains__(self, pkg_name):
+        return pkg_name in self._get_index()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  mirrors.py
+#
+#  Copyright © 2015-2017 Antergos
+#
+#  This file is part of antergos-welcome
+#
+#  Antergos-welcome is free software: you can redistribute it and/or modify
+#  it under the temms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Antergos-welcome is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Antergos-welcome. If not, see <http://www.gnu.org/licenses/>.
+
+""" Mirror performance statistics and ranking """
+
+import json
+import logging
+import os
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+_DEFAULT_STATS_PATH = "/var/cache/antergos-welcomed/mirrors.json"
+
+# Weight of the last measure in the moving average
+EWMA_ALPHA = 0.3
+
+# Transfers smaller than this only measure latency, not throughput
+MIN_MEASURE_BYTES = 16 * 1024
+
+# Bytes requested by an active probe
+PROBE_BYTES = 64 * 1024
+
+
+def get_mirror_key(url):
+    """ Mirrors are identified by host (shared by all repos) """
+    return urllib.parse.urlsplit(url).netloc
+
+
+class MirrorStats(object):
+    """ Keeps the measured throughput and failures of each mirror, and
+        sorts server lists so the best mirrors are tried first. Mirrors
+        without measures keep their position relative to each other and
+        are scored as the median known mirror. """
+
+    def __init__(self, path=_DEFAULT_STATS_PATH):
+        self.path = path
+        # host -> {'speed': bytes/s, 'ok': transfers, 'failed': failures}
+        self.stats = self._load()
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if not self.path:
+            return {}
+        try:
+            with open(self.path) as stats_file:
+                return json.load(stats_file)
+        except (OSError, ValueError):
+            return {}
+
+    def reload(self):
+        """ Reads again the stats saved by another process """
+        stats = self._load()
+        with self._lock:
+            self.stats = stats
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            stats = dict(self.stats)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'w') as stats_file:
+                json.dump(stats, stats_file)
+        except OSError as err:
+            logging.warning("Cannot save mirror stats: %s", err)
+
+    def record(self, url, nbytes, seconds, ok=True):
+        """ Registers a transfer from url (passive measure) """
+        key = get_mirror_key(url)
+        with self._lock:
+            entry = self.stats.setdefault(key, {'speed': None, 'ok': 0, 'failed': 0})
+            entry['updated'] = time.time()
+            if not ok:
+                entry['failed'] += 1
+                return
+            entry['ok'] += 1
+            if nbytes < MIN_MEASURE_BYTES or seconds <= 0:
+                return
+            speed = nbytes / seconds
+            if entry['speed'] is None:
+                entry['speed'] = speed
+            else:
+                entry['speed'] = EWMA_ALPHA * speed + (1 - EWMA_ALPHA) * entry['speed']
+
+    def get_score(self, url):
+        """ Expected throughput (bytes/s) penalised by failures. None if unknown """
+        entry = self.stats.get(get_mirror_key(url))
+        if not entry or entry.get('speed') is None:
+            if entry and entry.get('failed') and not entry.get('ok'):
+                # Never worked
+                return -1
+            return None
+        reliability = (entry['ok'] + 1) / (entry['ok'] + entry['failed'] + 1)
+        return entry['speed'] * reliability
+
+    def rank(self, servers):
+        """ Returns servers sorted by score (best first) """
+        with self._lock:
+            scores = [self.get_score(server) for server in servers]
+        known = sorted(score for score in scores if score is not None and score > 0)
+        median = known[(len(known) - 1) // 2] if known else 0
+        order = sorted(range(len(servers)),
+                       key=lambda i: (-(scores[i] if scores[i] is not None else median), i))
+        return [servers[i] for i in order]
+
+    def probe(self, url, timeout=10):
+        """ Active measure: downloads the first PROBE_BYTES of url """
+        request = urllib.request.Request(
+            url, headers={'Range': 'bytes=0-{}'.format(PROBE_BYTES - 1)})
+        start_time = time.monotonic()
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                nbytes = len(response.read(PROBE_BYTES))
+        except (urllib.error.URLError, OSError) as err:
+            logging.debug("Mirror probe %s failed: %s", url, err)
+            self.record(url, 0, 0, ok=False)
+            return False
+        self.record(url, nbytes, time.monotonic() - start_time)
+        return True
@@ -29,30 +29,46 @@
 #  along with Poodle; If not, see <http://www.gnu.org/licenses/>.
 
 """ Module interface to pyalpm """
-import subprocess
 
+import collections
 import sys
 import math
 import logging
 import os
 import queue
+import threading
 # If we are importing this module from backend:
 try:
     import alpm_events as alpm
     import pkginfo as pkginfo
     import pacman_conf as config
+    import localdb as localdb
+    import dbsync as dbsync
+    import fetch as fetch
+    import mirrors as mirrors
+    import cachemgr as cachemgr
 except ImportError as err:
     # If we are importing this module from frontend:
     try:
         import pacman.alpm_events as alpm
         import pacman.pkginfo as pkginfo
         import pacman.pacman_conf as config
+        import pacman.localdb as localdb
+        import pacman.dbsync as dbsync
+        import pacman.fetch as fetch
+        import pacman.mirrors as mirrors
+        import pacman.cachemgr as cachemgr
     except ImportError as err:
         # If we are running this module from command line:
         try:
             import poodle.backend.pacman.alpm_events as alpm
             import poodle.backend.pacman.pkginfo as pkginfo
             import poodle.backend.pacman.pacman_conf as config
+            import poodle.backend.pacman.localdb as localdb
+            import poodle.backend.pacman.dbsync as dbsync
+            import poodle.backend.pacman.fetch as fetch
+            import poodle.backend.pacman.mirrors as mirrors
+            import poodle.backend.pacman.cachemgr as cachemgr
         except ImportError as err:
             logging.error(err)
 
@@ -64,17 +80,52 @@ except ImportError as err:
 _DEFAULT_ROOT_DIR = "/"
 _DEFAULT_DB_PATH = "/var/lib/pacman"
 
+# Short phase names reported through progress_callback
+EVENT_PHASES = {
+    alpm.ALPM_EVENT_CHECKDEPS_START: 'checkdeps',
+    alpm.ALPM_EVENT_FILECONFLICTS_START: 'fileconflicts',
+    alpm.ALPM_EVENT_RESOLVEDEPS_START: 'resolvedeps',
+    alpm.ALPM_EVENT_INTERCONFLICTS_START: 'interconflicts',
+    alpm.ALPM_EVENT_INTEGRITY_START: 'integrity',
+    alpm.ALPM_EVENT_LOAD_START: 'load',
+    alpm.ALPM_EVENT_RETRIEVE_START: 'download',
+    alpm.ALPM_EVENT_DISKSPACE_START: 'diskspace',
+    alpm.ALPM_EVENT_KEYRING_START: 'keyring',
+    alpm.ALPM_EVENT_KEY_DOWNLOAD_START: 'keydownload'}
+
 
 class Pac(object):
     """ Communicates with libalpm using pyalpm """
 
-    def __init__(self, conf_path="/etc/pacman.conf", callback_queue=None, updates=False):
+    def __init__(self, conf_path="/etc/pacman.conf", callback_queue=None, updates=False,
+                 progress_callback=None, pacman_config=None):
         self.callback_queue = callback_queue
 
+        # Called as progress_callback(phase, package, done, total, percent)
+        self.progress_callback = progress_callback
+        self.phase = ""
+
         self.conflict_to_remove = None
 
         self.handle = None
 
+        # Max number of databases downloaded at the same time (parallel refresh)
+        self.refresh_workers = 4
+        # Seconds a database is considered fresh after being checked
+        # (a number or a dict repo -> seconds, see dbsync.DatabaseSync)
+        self.refresh_min_age = 0
+        # Result (fetched, skipped, failed) of each repo in the last refresh
+        self.last_refresh_results = {}
+
+        # Transaction being run and cancel flag (see interrupt)
+        self.transaction = None
+        self.cancel_requested = False
+
+        # name -> (version, reason, size) index of installed packages
+        self.localdb_index = None
+        # mtimes of DBPath/local and DBPath/sync when the handle was opened
+        self.db_mtimes = None
+
         # Some download indicators (used in cb_dl callback)
         self.last_dl_filename = None
         self.last_dl_progress = 0
@@ -89,6 +140,30 @@ class Pac(object):
 
         self.last_event = {}
 
+        # Measured mirror performance, used to sort each repo's servers
+        self.mirror_stats = mirrors.MirrorStats()
+        # Also called as transfer_callback(url, nbytes, seconds, ok) after
+        # each download, if set
+        self.transfer_callback = None
+
+        # Seconds without receiving data from a mirror before asking the
+        # next one too (see hedge.py). 0 disables it.
+        self.hedge_delay = 3
+
+        # Downloads packages in parallel (also used as libalpm fetch callback)
+        self.fetch_workers = 4
+        self.fetch_engine = fetch.FetchEngine(
+            max_workers=self.fetch_workers, progress_callback=self.cb_fetch_progress,
+            transfer_callback=self.on_transfer, hedge_delay=self.hedge_delay,
+            dl_callback=self.cb_dl)
+        self._fetch_lock = threading.Lock()
+
+        if pacman_config is not None:
+            # Already parsed by the caller
+            self.config = pacman_config
+            self.initialize(updates=updates)
+            return
+
         if not os.path.exists(conf_path):
             raise pyalpm.error
 
@@ -112,6 +187,8 @@ class Pac(object):
             root_dir = _DEFAULT_ROOT_DIR
             db_path = _DEFAULT_DB_PATH
 
+        self.db_path = db_path
+        self.db_mtimes = self._get_db_mtimes()
         self.handle = pyalpm.Handle(root_dir, db_path)
 
         if self.handle is None:
@@ -120,6 +197,10 @@ class Pac(object):
         if self.config is not None:
             self.config.apply(self.handle, updates)
 
+        self.localdb_index = localdb.LocalDbIndex(self.handle, root_dir, db_path)
+
+        self.rank_mirrors()
+
         # Set callback functions
 
         # Callback used for logging
@@ -141,24 +222,119 @@ class Pac(object):
         self.handle.progresscb = self.cb_progress
 
         # Downloading callback
-        self.handle.fetchcb = None
+        self.handle.fetchcb = self.fetch_engine.fetch
+
+    def rank_mirrors(self):
+        """ Sorts the servers of each sync db, fastest first """
+        server_lists = []
+        for db in self.handle.get_syncdbs():
+            servers = list(db.servers)
+            ranked = self.mirror_stats.rank(servers)
+            if ranked != servers:
+                logging.debug("%s servers: %s", db.name, ranked)
+                db.servers = ranked
+            server_lists.append(ranked)
+        # Used to find alternative mirrors for hedged requests
+        self.fetch_engine.server_lists = server_lists
+
+    def on_transfer(self, url, nbytes, seconds, ok=True):
+        """ A download has finished (or failed) """
+        self.mirror_stats.record(url, nbytes, seconds, ok)
+        if self.transfer_callback is not None:
+            self.transfer_callback(url, nbytes, seconds, ok)
+
+    def set_hedge_delay(self, delay):
+        """ Seconds before a stalled download is also asked to the next mirror """
+        self.hedge_delay = delay
+        self.fetch_engine.hedge_delay = delay
+
+    def set_fetch_workers(self, workers):
+        """ Number of packages downloaded at the same time """
+        self.fetch_workers = workers
+        self.fetch_engine.max_workers = workers
+        # Started again with the new size on next download
+        self.fetch_engine.shutdown()
+
+    def probe_mirrors(self):
+        """ Measures each mirror host once, downloading part of a db """
+        probed = set()
+        for db in self.handle.get_syncdbs():
+            for server in db.servers:
+                key = mirrors.get_mirror_key(server)
+                if key in probed:
+                    continue
+                probed.add(key)
+                self.mirror_stats.probe("{0}/{1}.db".format(server.rstrip('/'), db.name))
+        self.mirror_stats.save()
+        self.rank_mirrors()
 
     def release(self):
         if self.handle is not None:
             del self.handle
             self.handle = None
+            self.localdb_index = None
             if os.path.exists('/var/lib/pacman/db.lck'):
                 os.remove('/var/lib/pacman/db.lck')
 
-    @staticmethod
-    def finalize_transaction(transaction):
+    def reload(self):
+        """ libalpm keeps the databases in memory. Opens the handle again
+            to read them after another process has changed them. """
+        self.handle = None
+        self.initialize()
+
+    def _get_db_mtimes(self):
+        mtimes = []
+        for name in ("local", "sync"):
+            try:
+                mtimes.append(os.stat(os.path.join(self.db_path, name)).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def reload_if_changed(self):
+        """ Reloads the handle if the local or sync databases have changed
+            since it was opened (pacman or our transaction process ran) """
+        if self._get_db_mtimes() != self.db_mtimes:
+            logging.debug("Databases have changed, opening alpm handle again")
+            self.reload()
+
+    def shutdown(self):
+        """ Saves state kept between runs and stops download threads """
+        self.mirror_stats.save()
+        self.fetch_engine.shutdown()
+
+    def interrupt(self):
+        """ Asks the running transaction to stop at the next safe point
+            (before commit, between databases or through libalpm's own
+            interruption points while committing) """
+        self.cancel_requested = True
+        # Downloads of the transaction (download_packages) stop too
+        self.fetch_engine.cancel()
+        if self.transaction is not None:
+            try:
+                self.transaction.interrupt()
+            except pyalpm.error as pyalpm_error:
+                logging.debug("Can't interrupt transaction: %s", pyalpm_error)
+
+    def reset_interrupt(self):
+        """ Forgets an interrupt() of a previous job """
+        self.cancel_requested = False
+        self.fetch_engine.reset_cancel()
+
+    def finalize_transaction(self, transaction):
         """ Commit a transaction """
         all_ok = True
         try:
             logging.debug(_("Prepare alpm transaction..."))
             transaction.prepare()
-            logging.debug(_("Commit alpm transaction..."))
-            transaction.commit()
+            if not self.cancel_requested:
+                self.download_packages(transaction)
+            if self.cancel_requested:
+                logging.info(_("Transaction cancelled"))
+                all_ok = False
+            else:
+                logging.debug(_("Commit alpm transaction..."))
+                transaction.commit()
         except pyalpm.error as pyalpm_error:
             msg = _("Can't finalize alpm transaction: %s")
             logging.error(msg, pyalpm_error)
@@ -166,9 +342,37 @@ class Pac(object):
         finally:
             logging.debug(_("Releasing alpm transaction..."))
             transaction.release()
+            self.transaction = None
+            self.mirror_stats.save()
             logging.debug(_("Alpm transaction done."))
             return all_ok
 
+    def download_packages(self, transaction):
+        """ Downloads (in parallel) the packages of a prepared transaction
+            that are not in the cache yet """
+        cachedirs = self.handle.cachedirs
+        files = []
+        for pkg in transaction.to_add:
+            servers = pkg.db.servers if pkg.db is not None else []
+            if not servers:
+                # Not from a sync db (local file)
+                continue
+            if any(os.path.exists(os.path.join(cachedir, pkg.filename))
+                   for cachedir in cachedirs):
+                continue
+            urls = ["{0}/{1}".format(server.rstrip('/'), pkg.filename) for server in servers]
+            files.append((pkg.filename, urls, pkg.size))
+
+        if not files:
+            return
+        logging.debug("Downloading %d packages", len(files))
+        self.total_packages_to_download = len(files)
+        self.downloaded_packages = 0
+        failed = self.fetch_engine.download_many(files, cachedirs[0])
+        if failed:
+            # libalpm will try again using fetchcb
+            logging.warning("Could not download %s", ", ".join(failed))
+
     def init_transaction(self, options={}):
         """ Transaction initialization """
         transaction = None
@@ -191,6 +395,7 @@ class Pac(object):
             msg = _("Can't init alpm transaction: %s")
             logging.error(msg, pyalpm_error)
         finally:
+            self.transaction = transaction
             return transaction
 
     '''
@@ -242,63 +447,117 @@ class Pac(object):
 
         return self.finalize_transaction(transaction)
 
-    def refresh(self, force=False):
-        """ Sync databases like pacman -Sy """
+    def refresh(self, force=False, parallel=False, repos=None):
+        """ Sync databases like pacman -Sy. If repos is given, only those
+            are synced. The result of each repo is left in
+            last_refresh_results (see dbsync). """
         if self.handle is None:
             logging.error(_("alpm is not initialised"))
             raise pyalpm.error
 
+        self.last_refresh_results = collections.OrderedDict()
+        if parallel:
+            return self.refresh_parallel(force)
+
         res = True
+        results = self.last_refresh_results
         for db in self.handle.get_syncdbs():
+            if repos is not None and db.name not in repos:
+                continue
+            if not self.config.repo_allows(db.name, 'Sync'):
+                results[db.name] = dbsync.SKIPPED
+                continue
+            if self.cancel_requested:
+                logging.info(_("Refresh cancelled"))
+                return False
             transaction = self.init_transaction()
             if transaction:
-                db.update(force)
-                transaction.release()
+                try:
+                    results[db.name] = dbsync.FETCHED if db.update(force) else dbsync.SKIPPED
+                except pyalpm.error as pyalpm_error:
+                    logging.error(_("Can't update %s database: %s"), db.name, pyalpm_error)
+                    results[db.name] = dbsync.FAILED
+                    res = False
+                finally:
+                    transaction.release()
+                    self.transaction = None
             else:
+                results[db.name] = dbsync.FAILED
                 res = False
         return res
 
-    def check_updates(self):
-        """ Check for available updates. """
-        # Repo "Usage" property is not fully supported in pyalpm. Tried to work-around that
-        # but it isn't working out so we'll use the "checkupdates" command for the time being.
-        if not True:
-            if self.handle is not None:
-                self.release()
-                self.initialize(updates=True)
-
-            self.refresh()
-            transaction = self.init_transaction()
-            res = []
-            if transaction:
-                transaction.sysupgrade(False)
-                if len(transaction.to_add) + len(transaction.to_remove) == 0:
-                    logging.info('no pkgs to upgrade')
-                    transaction.release()
-                else:
-                    logging.info(
-                        't_add, to_remove: %s | %s' % (transaction.to_add, transaction.to_remove))
-                    logging.info(dir(transaction.to_add[0]))
-                    res = [x.name for x in transaction.to_add]
-            self.release()
-            self.initialize(updates=False)
-
-            return res
-
+    def refresh_parallel(self, force=False):
+        """ Downloads all sync databases at the same time and reloads them.
+            Returns True if no database failed """
+        repos = collections.OrderedDict()
+        results = collections.OrderedDict()
+        for db in self.handle.get_syncdbs():
+            if self.config.repo_allows(db.name, 'Sync'):
+                repos[db.name] = list(db.servers)
+            else:
+                # Usage in pacman.conf does not allow to sync this repo
+                results[db.name] = dbsync.SKIPPED
+        sync_path = os.path.join(self.config.options["DBPath"], "sync")
+        syncer = dbsync.DatabaseSync(
+            sync_path, max_workers=self.refresh_workers, min_age=self.refresh_min_age,
+            transfer_callback=self.on_transfer, hedge_delay=self.hedge_delay,
+            cancelled=self.fetch_engine.cancelled)
+
+        if self.cancel_requested:
+            logging.info(_("Refresh cancelled"))
+            return False
+        # Hold the db lock while the files are replaced
+        transaction = self.init_transaction()
+        if transaction is None:
+            return False
         try:
-            check = subprocess.check_output(['checkupdates'], stderr=subprocess.STDOUT,
-                                            universal_newlines=True)
-        except subprocess.CalledProcessError as err:
-            check = None
-            logging.error((err.returncode, err.output))
-
-        if check is not None:
-            check = [str(x) for x in check.split('\n') if
-                     str(x) != '' and str(x) not in self.handle.noupgrades and
-                     str(x) not in self.handle.ignorepkgs]
-            logging.info(self.handle.ignorepkgs)
+            results.update(syncer.sync(repos, force))
+        finally:
+            transaction.release()
+            self.transaction = None
+
+        logging.debug("Refresh results: %s", results)
+        self.last_refresh_results = results
+        self.mirror_stats.save()
+        if dbsync.FETCHED in results.values():
+            self.reload()
+        return dbsync.FAILED not in results.values()
+
+    def get_updates(self):
+        """ Compares installed packages against the (already synced) repos.
+            Returns a list of (name, old version, new version, download size).
+            Ignored packages and groups (IgnorePkg, IgnoreGroup) and repos
+            whose Usage does not include updates are skipped. """
+        self.reload_if_changed()
+        ignorepkgs = set(self.handle.ignorepkgs)
+        ignoregrps = set(self.handle.ignoregrps)
+        syncdbs = [db for db in self.handle.get_syncdbs()
+                   if self.config.repo_allows(db.name, 'Upgrade')]
+        vercmp = pyalpm.vercmp
+
+        updates = []
+        for name, (old_version, reason, size) in self.localdb_index.items():
+            if name in ignorepkgs:
+                continue
+            for db in syncdbs:
+                pkg = db.get_pkg(name)
+                if pkg is None:
+                    continue
+                # The first repo where the package is found wins (as pacman does)
+                new_version = pkg.version
+                if new_version != old_version and vercmp(new_version, old_version) > 0:
+                    if not ignoregrps or ignoregrps.isdisjoint(pkg.groups):
+                        updates.append(
+                            (name, old_version, new_version, pkg.download_size))
+                break
+        updates.sort()
+        return updates
 
-        return check if check is not None else []
+    def check_updates(self):
+        """ Check for available updates. Returns a list of strings with the
+            same format as the checkupdates script ("name old -> new") """
+        return ["{0} {1} -> {2}".format(name, old_version, new_version)
+                for name, old_version, new_version, size in self.get_updates()]
 
     def install(self, pkgs, conflicts=[], options={}):
         """ Install a list of packages like pacman -S """
@@ -387,11 +646,26 @@ class Pac(object):
         if len(transaction.to_add) + len(transaction.to_remove) == 0:
             logging.debug("system_upgrade: nothing to do")
             transaction.release()
+            self.transaction = None
             return 0
         else:
-            ok = transaction.finalize(t)
+            ok = self.finalize_transaction(transaction)
             return True if ok else False
 
+    def prefetch_upgrades(self):
+        """ Downloads pending upgrades to CacheDir without installing them """
+        return self.system_upgrade({'downloadonly': True})
+
+    def clean_cache(self, keep_versions=3, max_bytes=None, dry_run=False):
+        """ Removes old packages from CacheDir (see cachemgr.CacheManager).
+            Returns (list of removed files, bytes freed) """
+        self.reload_if_changed()
+        installed = dict((name, version)
+                         for name, (version, reason, size) in self.localdb_index.items())
+        manager = cachemgr.CacheManager(
+            self.handle.cachedirs, keep_versions, max_bytes, pyalpm.vercmp)
+        return manager.clean(installed, dry_run)
+
     @staticmethod
     def find_sync_package(pkgname, syncdbs):
         """ Finds a package name in a list of DBs
@@ -490,6 +764,11 @@ class Pac(object):
                 self.callback_queue.join()
                 sys.exit(1)
 
+    def report_progress(self, phase, package="", done=0, total=0, percent=0.0):
+        """ Structured progress (percent goes from 0 to 100) """
+        if self.progress_callback is not None:
+            self.progress_callback(phase, package, done, total, percent)
+
     # Callback functions
 
     @staticmethod
@@ -539,6 +818,11 @@ class Pac(object):
         if len(action) > 0:
             self.queue_event('info', action)
 
+        phase = EVENT_PHASES.get(event_type)
+        if phase:
+            self.phase = phase
+            self.report_progress(phase)
+
     @staticmethod
     def cb_log(level, line):
         """ Log pyalpm warning and error messages.
@@ -574,12 +858,16 @@ class Pac(object):
             msg = _("Installing {0} ({1}/{2})").format(target, i, n)
             self.queue_event('info', msg)
 
+            self.report_progress('install', target, i, n, percent)
+
             percent = i / n
             self.queue_event('percent', percent)
         else:
             # msg = _("Checking and loading packages... ({0} targets)").format(n)
             # self.queue_event('info', msg)
 
+            self.report_progress(self.phase, "", i, n, percent)
+
             percent /= 100
             self.queue_event('percent', percent)
 
@@ -609,6 +897,7 @@ class Pac(object):
 
             self.queue_event('info', text)
             self.queue_event('percent', str(0))
+            self.report_progress('download', filename, 0, total, 0.0)
         else:
             # Compute a progress indicator
             if self.last_dl_total_size > 0:
@@ -622,17 +911,21 @@ class Pac(object):
                 # logging.debug("filename [%s], tx [%d], total [%d]", filename, tx, total)
                 self.last_dl_progress = progress
                 self.queue_event('percent', progress)
+                self.report_progress(
+                    'download', self.last_dl_filename, tx, total, min(progress, 1.0) * 100)
 
-    def is_package_installed(self, package_name):
-        db = self.handle.get_localdb()
-        pkgs = db.search(*[package_name])
-        names = []
-        for pkg in pkgs:
-            names.append(pkg.name)
-        if package_name in names:
-            return True
-        else:
-            return False
+    def cb_fetch_progress(self, filename, tx, total, finished):
+        """ Aggregated progress of the parallel downloads (all files) """
+        with self._fetch_lock:
+            self.downloaded_packages = finished
+            self.last_dl_filename = filename
+            self.last_dl_total_size = total
+            progress = tx / total if total > 0 else 0
+            if progress > self.last_dl_progress or tx == 0:
+                self.last_dl_progress = progress
+                self.queue_event('percent', progress)
+                self.report_progress(
+                    'download', filename, tx, total, min(progress, 1.0) * 100)
 
 
 ''' Test case '''
@@ -189,6 +189,15 @@ class PacmanConfig(collections.OrderedDict):
         if options.debug:
             _logmask = 0xffff
 
+    def repo_allows(self, repo, usage):
+        """ Checks if repo's Usage includes usage (Sync, Search, Install or Upgrade) """
+        value = self.repos.get(repo, {}).get('usage')
+        if not value:
+            # Default is All
+            return True
+        usages = value.replace(',', ' ').split()
+        return 'All' in usages or usage in usages
+
     def apply(self, handle, updates=False):
         # File paths
         handle.logfile = self.options["LogFile"]
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  query.py
+#
+#  Copyright © 2015-2017 Antergos
+#
+#  This file is part of antergos-welcome
+#
+#  Antergos-welcome is free software: you can redistribute it and/or modify
+#  it under the temms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Antergos-welcome is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Antergos-welcome. If not, see <http://www.gnu.org/licenses/>.
+
+""" Read only alpm handles, used to answer queries while Pac runs transactions """
+
+import contextlib
+import logging
+import threading
+
+# If we are importing this module from backend:
+try:
+    import localdb as localdb
+    import pkginfo as pkginfo
+except ImportError:
+    import pacman.localdb as localdb
+    import pacman.pkginfo as pkginfo
+
+try:
+    import pyalpm
+except ImportError as err:
+    logging.error(err)
+
+
+class QueryHandles(object):
+    """ Pool of pyalpm handles that are never used to run transactions, so
+        queries don't have to wait for (nor interfere with) the handle
+        that is committing one. libalpm is not thread safe, so each handle
+        is used by one thread at a time; up to max_handles queries run at
+        the same time.
+
+        libalpm reads each database once per handle, so the handles work
+        as a snapshot of the databases. invalidate() must be called when
+        they change (after a transaction or a refresh): handles of the old
+        snapshot are dropped as they are returned, and new ones are opened
+        on demand. Opening one is cheap, packages are only read when they
+        are asked for. Installed packages are looked up in a
+        localdb.LocalDbIndex, which notices changes made by someone else
+        (pacman) through the mtime of DBPath/local. """
+
+    def __init__(self, config, max_handles=2):
+        self.config = config
+        self.max_handles = max_handles
+        # Incremented each time the snapshot is invalidated
+        self.generation = 0
+        self._idle = []
+        self._open_handles = 0
+        self._cond = threading.Condition()
+        self.installed = localdb.LocalDbIndex(
+            None, config.options["RootDir"], config.options["DBPath"])
+
+    def _open(self):
+        handle = pyalpm.Handle(self.config.options["RootDir"], self.config.options["DBPath"])
+        self.config.apply(handle)
+        return handle
+
+    @contextlib.contextmanager
+    def borrow(self):
+        """ with pool.borrow() as handle: ... """
+        with self._cond:
+            while not self._idle and self._open_handles >= self.max_handles:
+                self._cond.wait()
+            generation = self.generation
+            if self._idle:
+                handle = self._idle.pop()
+            else:
+                handle = None
+                self._open_handles += 1
+        try:
+            if handle is None:
+                handle = self._open()
+                logging.debug("Query handle opened (generation %d)", generation)
+        except Exception:
+            with self._cond:
+                self._open_handles -= 1
+                self._cond.notify()
+            raise
+        try:
+            yield handle
+        finally:
+            with self._cond:
+                if generation == self.generation:
+                    self._idle.append(handle)
+                else:
+                    # Old snapshot
+                    self._open_handles -= 1
+                self._cond.notify()
+
+    def invalidate(self):
+        """ Databases have changed. Next queries will use a new snapshot. """
+        with self._cond:
+            self.generation += 1
+            self._open_handles -= len(self._idle)
+            self._idle = []
+            self._cond.notify_all()
+        self.installed.invalidate()
+
+    def is_warm(self):
+        """ True if installed packages can be looked up without reading the
+            local db (they are known and the local db has not changed since) """
+        return self.installed.is_warm()
+
+    def _get_installed(self):
+        if self.installed.is_stale():
+            # Local db modified by someone else, the handles are old too
+            self.invalidate()
+        return self.installed
+
+    @staticmethod
+    def _find_package(pkg_name, dbs):
+        for db in dbs:
+            pkg = db.get_pkg(pkg_name)
+            if pkg is not None:
+                return pkg
+        return None
+
+    def get_package_info(self, pkg_name, local=False):
+        """ Same as Pac.get_package_info """
+        with self.borrow() as handle:
+            if local:
+                dbs, style = [handle.get_localdb()], 'local'
+            else:
+                dbs, style = handle.get_syncdbs(), 'sync'
+            pkg = self._find_package(pkg_name, dbs)
+            if pkg is None:
+                logging.debug("Package '%s' was not found.", pkg_name)
+                return {}
+            return pkginfo.get_pkginfo(pkg, level=2, style=style)
+
+    def get_packages_info(self):
+        """ Information of every package of every repo (like pacman -Si) """
+        packages_info = {}
+        with self.borrow() as handle:
+            for repo in handle.get_syncdbs():
+                for pkg in repo.pkgcache:
+                    packages_info[pkg.name] = pkginfo.get_pkginfo(
+                        pkg, level=2, style='sync')
+        return packages_info
+
+    def is_package_installed(self, package_name):
+        return package_name in self._get_installed()
+
+    def get_installed_versions(self, pkg_names):
+        """ Returns a dict name -> installed version ("" if not installed) """
+        return self._get_installed().get_versions(pkg_names)
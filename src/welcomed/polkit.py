@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  polkit.py
+#
+#  Copyright © 2015-2017 Antergos
+#
+#  This file is part of antergos-welcome
+#
+#  Antergos-welcome is free software: you can redistribute it and/or modify
+#  it under the temms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Antergos-welcome is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Antergos-welcome. If not, see <http://www.gnu.org/licenses/>.
+
+""" Asynchronous polkit authorization checks """
+
+import logging
+
+import gi
+gi.require_version('GLib', '2.0')
+gi.require_version('Gio', '2.0')
+from gi.repository import GLib, Gio
+
+POLKIT_NAME = "org.freedesktop.PolicyKit1"
+POLKIT_PATH = "/org/freedesktop/PolicyKit1/Authority"
+POLKIT_IFACE = "org.freedesktop.PolicyKit1.Authority"
+
+# CheckAuthorization flags
+ALLOW_USER_INTERACTION = 1
+
+
+def check_authorization(connection, sender, action_id, details, callback,
+                        interactive=True):
+    """ Asks polkit if sender (unique bus name) may do action_id, without
+        waiting for the answer. callback(authorized) is called from the
+        main loop when polkit answers, which may take as long as the user
+        needs to type a password. Errors count as not authorized. """
+    subject = ('system-bus-name', {'name': GLib.Variant('s', sender)})
+    flags = ALLOW_USER_INTERACTION if interactive else 0
+    parameters = GLib.Variant('((sa{sv})sa{ss}us)', (subject, action_id, details, flags, ''))
+
+    def on_reply(conn, result, user_data):
+        try:
+            reply = conn.call_finish(result)
+            authorized, is_challenge, result_details = reply.unpack()[0]
+        except GLib.Error as err:
+            logging.error("Polkit check of %s for %s failed: %s", action_id, sender, err)
+            authorized = False
+        callback(bool(authorized))
+
+    # No timeout: the user may take a while to answer the dialog
+    connection.call(
+        POLKIT_NAME, POLKIT_PATH, POLKIT_IFACE, "CheckAuthorization", parameters,
+        GLib.VariantType.new('((bba{ss}))'), Gio.DBusCallFlags.NONE, GLib.MAXINT,
+        None, on_reply, None)
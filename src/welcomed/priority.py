@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  priority.py
+#
+#  Copyright © 2015-2017 Antergos
+#
+#  This file is part of antergos-welcome
+#
+#  Antergos-welcome is free software: you can redistribute it and/or modify
+#  it under the temms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Antergos-welcome is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Antergos-welcome. If not, see <http://www.gnu.org/licenses/>.
+
+""" CPU and I/O priority of our threads (Linux) """
+
+import ctypes
+import errno
+import logging
+import os
+import platform
+
+LOW_NICE = 19
+NORMAL_NICE = 0
+
+# ionice classes
+IOPRIO_CLASS_NONE = 0
+IOPRIO_CLASS_IDLE = 3
+
+# ioprio_set(2) arguments (see linux/ioprio.h)
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+
+# ioprio_set syscall number of each architecture (glibc has no wrapper)
+SYS_IOPRIO_SET = {
+    'x86_64': 251,
+    'i686': 289,
+    'i386': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'armv6l': 314}
+
+_libc = None
+
+
+def _syscall(*args):
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+    if _libc.syscall(*args) < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+def ioprio_set(tid, ioclass, data=0):
+    """ Sets the I/O priority of thread tid (same as ionice -p, without
+        starting a process) """
+    number = SYS_IOPRIO_SET.get(platform.machine())
+    if number is None:
+        raise OSError(errno.ENOSYS, "ioprio_set is unknown on " + platform.machine())
+    _syscall(number, IOPRIO_WHO_PROCESS, tid, (ioclass << IOPRIO_CLASS_SHIFT) | data)
+
+
+def set_thread_priority(tid, low=True):
+    """ Sets the CPU (nice) and I/O (ionice) priority of thread tid.
+        On Linux both are per thread, so other threads are not affected. """
+    nice = LOW_NICE if low else NORMAL_NICE
+    ioclass = IOPRIO_CLASS_IDLE if low else IOPRIO_CLASS_NONE
+    try:
+        os.setpriority(os.PRIO_PROCESS, tid, nice)
+    except OSError as err:
+        logging.warning("Cannot change priority of thread %d: %s", tid, err)
+    try:
+        ioprio_set(tid, ioclass)
+    except OSError as err:
+        logging.warning("Cannot change I/O priority of thread %d: %s", tid, err)
+
+
+def set_process_priority(pid, low=True):
+    """ Same as set_thread_priority for every thread of process pid
+        (threads keep the priority they were started with) """
+    try:
+        tids = [int(tid) for tid in os.listdir("/proc/{}/task".format(pid))]
+    except OSError as err:
+        logging.warning("Cannot list threads of process %d: %s", pid, err)
+        return
+    for tid in tids:
+        set_thread_priority(tid, low)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  progress.py
+#
+#  Copyright © 2015-2017 Antergos
+#
+#  This file is part of antergos-welcome
+#
+#  Antergos-welcome is free software: you can redistribute it and/or modify
+#  it under the temms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Antergos-welcome is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Antergos-welcome. If not, see <http://www.gnu.org/licenses/>.
+
+""" Rate limiting of job progress signals """
+
+import threading
+import time
+
+import gi
+gi.require_version('GLib', '2.0')
+from gi.repository import GLib
+
+
+class ProgressThrottle(object):
+    """ Calls emit(uid, phase, package, done, total, percent) at most
+        max_rate times per second for each uid. Intermediate reports are
+        dropped, but the last one is always sent (from the GLib main loop)
+        so clients never miss the final state of a phase. """
+
+    def __init__(self, emit, max_rate=4):
+        self.emit = emit
+        self.interval = 1.0 / max_rate if max_rate > 0 else 0
+        self._last_emit = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def report(self, uid, phase, package, done, total, percent):
+        progress = (uid, phase, package, done, total, percent)
+        now = time.monotonic()
+        with self._lock:
+            wait = self._last_emit.get(uid, 0) + self.interval - now
+            if wait > 0:
+                # Too soon. Keep it, a timeout will send the latest one.
+                if uid not in self._pending:
+                    GLib.timeout_add(int(wait * 1000) + 1, self._flush, uid)
+                self._pending[uid] = progress
+                return
+            self._last_emit[uid] = now
+        self.emit(*progress)
+
+    def _flush(self, uid):
+        with self._lock:
+            progress = self._pending.pop(uid, None)
+            if progress is not None:
+                self._last_emit[uid] = time.monotonic()
+        if progress is not None:
+            self.emit(*progress)
+        return False
+
+    def forget(self, uid):
+        """ Sends the pending report of a finished job and drops its state """
+        with self._lock:
+            progress = self._pending.pop(uid, None)
+            self._last_emit.pop(uid, None)
+        if progress is not None:
+            self.emit(*progress)
@@ -20,16 +20,14 @@
 #  You should have received a copy of the GNU General Public License
 #  along with Antergos-welcome. If not, see <http://www.gnu.org/licenses/>.
 
+import functools
 import json
 import logging
-import os
 import subprocess
 import sys
 import threading
 import uuid
-from queue import Queue
 import time
-import errno
 
 import gi
 gi.require_version('GLib', '2.0')
@@ -46,6 +44,10 @@ except ImportError as err:
 
 try:
     from pacman import pac
+    from pacman import catalog
+    from pacman import mirrors
+    from pacman import pacman_conf
+    from pacman import query
 except ImportError as err:
     logging.error(err.msg)
     msg = "Can't find {} bindings. Unable to install/uninstall apps".format(
@@ -54,8 +56,50 @@ except ImportError as err:
     sys.exit(-1)
 
 
+import authcache
+import dblock
+import dispatch
+import idle
+import jobqueue
+import metrics
+import polkit
+import priority
+import progress
+import txworker
+
 INTERFACE = 'com.antergos.welcome'
 
+POLKIT_ACTION_ID = "com.antergos.welcome.install"
+POLKIT_DETAILS = {
+    'polkit.icon': 'antergos-welcome',
+    'polkit.message': 'antergos-welcome'}
+
+PACMAN_CONF = "/etc/pacman.conf"
+
+# Seconds between writes of the metrics textfile
+METRICS_INTERVAL = 15
+
+# Sent as the packages of command_finished for jobs that could not be run
+ALPM_UNAVAILABLE = "error:alpm unavailable"
+
+# Adjacent queued jobs of the same group are run in a single transaction
+COALESCE_GROUPS = {
+    'install': 'install',
+    'install_packages': 'install',
+    'remove': 'remove',
+    'refresh': 'refresh',
+    'check_updates': 'check_updates'}
+
+
+def dbus_method(method):
+    """ Registers each call to a D-Bus method as activity (see idle.py) """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        dbus_context = kwargs.get('dbus_context')
+        self.idle_monitor.touch(dbus_context.sender if dbus_context else None)
+        return method(self, *args, **kwargs)
+    return wrapper
+
 
 class DBusService(object):
     """
@@ -63,11 +107,17 @@ class DBusService(object):
         <interface name='com.antergos.welcome'>
             <method name='get_package_exists'>
                 <arg type='s' name='package_name' direction='in'/>
-                <arg type='s' name='response' direction='out'/>
+                <arg type='b' name='response' direction='out'/>
             </method>
             <method name='check_updates'>
+                <arg type='s' name='uid' direction='out'/>
+            </method>
+            <method name='get_cached_updates'>
                 <arg type='as' name='response' direction='out'/>
             </method>
+            <method name='get_cached_updates_info'>
+                <arg type='a(ssst)' name='response' direction='out'/>
+            </method>
             <method name='refresh_alpm'>
                 <arg type='s' name='uid' direction='out'/>
             </method>
@@ -86,6 +136,13 @@ class DBusService(object):
             <method name='system_upgrade'>
                 <arg type='as' name='response' direction='out'/>
             </method>
+            <method name='clean_cache'>
+                <arg type='s' name='uid' direction='out'/>
+            </method>
+            <method name='cancel_job'>
+                <arg type='s' name='uid' direction='in'/>
+                <arg type='b' name='response' direction='out'/>
+            </method>
             <method name='exit'/>
             <method name='is_alpm_on'>
                 <arg type='b' name='response' direction='out'/>
@@ -94,47 +151,174 @@ class DBusService(object):
                 <arg type='s' name='package_name' direction='in'/>
                 <arg type='b' name='response' direction='out'/>
             </method>
+            <method name='get_installed_packages'>
+                <arg type='as' name='package_names' direction='in'/>
+                <arg type='a{ss}' name='response' direction='out'/>
+            </method>
+            <method name='get_metrics'>
+                <arg type='a{sd}' name='response' direction='out'/>
+            </method>
+            <signal name='progress'>
+                <arg type='s' name='uid'/>
+                <arg type='s' name='phase'/>
+                <arg type='s' name='package'/>
+                <arg type='t' name='done'/>
+                <arg type='t' name='total'/>
+                <arg type='d' name='percent'/>
+            </signal>
             <property name="command_finished" type="(ssas)" access="readwrite">
                 <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
             </property>
+            <property name="catalog_ready" type="b" access="read">
+                <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
+            </property>
         </interface>
     </node>
     """
 
-    def __init__(self, mainloop, object_path="/com/antergos/welcome"):
-        self.alpm = None
+    def __init__(self, mainloop, object_path="/com/antergos/welcome", bus=None,
+                 auth_ttl=60, progress_rate=4, updates_ttl=1800, refresh_min_age=300,
+                 prefetch=False, probe_mirrors=False, hedge_delay=3, fetch_workers=4,
+                 cache_keep=3, cache_budget=4096, idle_timeout=0,
+                 metrics_textfile=None):
+        # pyalpm handle, created when it is first needed (see alpm property)
+        self._alpm = None
+        self._alpm_lock = threading.Lock()
         self.updates_available = self.store_loaded = False
         self.mainloop = mainloop
         self._command_finished = ()
 
+        # Counters and histograms (see get_metrics)
+        self.metrics = self._create_metrics()
+        self.metrics_textfile = metrics_textfile
+
+        # Exit after idle_timeout seconds without activity (0 disables it)
+        self.idle_monitor = idle.IdleMonitor(
+            idle_timeout, self._is_busy, self._on_idle)
+        # dispatch.Publication of this object (set by whoever publishes it)
+        self.publication = None
+
+        # Result of the last update check. It is valid for updates_ttl
+        # seconds or until the databases change (refresh, transactions).
+        self.updates = []
+        self.updates_info = []
+        self.updates_checked_at = None
+        self.updates_ttl = updates_ttl
+
+        # Seconds before a database is checked again on refresh
+        self.refresh_min_age = refresh_min_age
+
+        # Measure mirrors before each refresh
+        self.probe_mirrors = probe_mirrors
+        # Seconds before a stalled download is also asked to the next mirror
+        self.hedge_delay = hedge_delay
+        # Packages downloaded at the same time
+        self.fetch_workers = fetch_workers
+
+        # Package cache cleaning: versions kept per package and size budget (MiB)
+        self.cache_keep = cache_keep
+        self.cache_budget = cache_budget
+
+        # Download updates in the background after an update check
+        self.prefetch = prefetch
+        self._prefetch_queued = False
+        # Set when the running prefetch is interrupted to let a job through
+        self._prefetch_preempted = False
+
         # We will store package metadata before its needed to improve
         # performance on the frontend.
         self.all_packages = {}
+        self._catalog_ready = False
+        self._catalog_generation = 0
+
+        # At most progress_rate progress signals per second and job
+        self.progress_throttle = progress.ProgressThrottle(
+            self._emit_progress, progress_rate)
 
-        self.initialize_alpm()
+        # Seconds spent in each startup step (logged by antergos-welcomed)
+        self.startup_times = {}
+
+        start_time = time.monotonic()
+        try:
+            self.config = pacman_conf.PacmanConfig(PACMAN_CONF)
+        except (OSError, pacman_conf.InvalidSyntax) as err:
+            logging.error("Cannot read %s: %s", PACMAN_CONF, err)
+            sys.exit(-1)
+        self.startup_times['config'] = time.monotonic() - start_time
+
+        # Read only handles used by queries, so they don't wait for jobs
+        self.query = query.QueryHandles(self.config)
+
+        # Package catalog stored on disk between runs
+        self.catalog_snapshot = catalog.CatalogSnapshot(
+            self.config.options["DBPath"], self.config.repos.keys())
 
         # File lock db.lck (pacman)
         # Times are in seconds
-        self.is_locked = False
-        self.lock_file = "/var/lib/pacman/db.lck"
+        self.db_lock = dblock.DbLockWatcher(self.config.options["DBPath"])
         self.lock_timeout = 30
-        self.lock_delay = 1
+
+        # Polkit authorizations already granted (per sender)
+        self.auth_cache = authcache.AuthorizationCache(auth_ttl)
+        # (sender, action_id) -> callbacks waiting for the same polkit check.
+        # Only used from the main loop.
+        self.pending_auth = {}
+        if bus is not None:
+            bus.subscribe(
+                sender="org.freedesktop.DBus",
+                iface="org.freedesktop.DBus",
+                signal="NameOwnerChanged",
+                signal_fired=self._on_name_owner_changed)
 
         # lock to serialize alpm petitions (install/uninstall)
         self.lock = threading.Lock()
 
-        self.command_queue = Queue()
+        self.command_queue = jobqueue.JobQueue(on_dequeue=self._on_job_dequeued)
+        # Jobs being run right now by the worker thread
+        self._running_jobs = []
+        self._worker_tid = None
+        self._running_lock = threading.Lock()
+        # Transactions run in a child process
+        self.tx_process = txworker.TransactionProcess(
+            on_progress=self._on_alpm_progress, on_transfer=self._on_transfer,
+            hedge_delay=hedge_delay, fetch_workers=fetch_workers)
         t = threading.Thread(target=self._command_queue_worker)
         t.daemon = True
         t.start()
 
+        self.warm_catalog()
+        self.idle_monitor.start()
+
+        if self.metrics_textfile:
+            # For node_exporter's textfile collector
+            GLib.timeout_add_seconds(
+                METRICS_INTERVAL, self.metrics.write_textfile, self.metrics_textfile)
+
+    @property
+    def alpm(self):
+        """ pyalpm handle. It is created on first use (registering every sync
+            db is the slowest part of starting up). None if it fails. """
+        if self._alpm is None:
+            with self._alpm_lock:
+                if self._alpm is None:
+                    self.initialize_alpm()
+        return self._alpm
+
     def initialize_alpm(self):
+        start_time = time.monotonic()
         try:
-            self.alpm = pac.Pac()
-            logging.debug("Alpm library initialized")
+            alpm = pac.Pac(progress_callback=self._on_alpm_progress,
+                           pacman_config=self.config)
+            alpm.refresh_min_age = self.refresh_min_age
+            alpm.transfer_callback = self._on_transfer
+            alpm.set_hedge_delay(self.hedge_delay)
+            alpm.set_fetch_workers(self.fetch_workers)
         except Exception as err:
-            logging.error("Cannot initialize alpm library")
-            sys.exit(-1)
+            logging.error("Cannot initialize alpm library: %s", err)
+            return False
+        self._alpm = alpm
+        logging.debug("Alpm library initialized in %.3fs", time.monotonic() - start_time)
+        return True
 
     @staticmethod
     def get_uuid():
@@ -142,79 +326,248 @@ class DBusService(object):
 
     # DBus methods -------------------------------------------------------------
 
+    @dbus_method
+    @dispatch.threaded(fast_path=lambda self, package_name: self.catalog_ready)
     def get_package_exists(self, package_name):
         """ Checks for package in ALPM database. Return True if found, otherwise False. """
-        pkg = self.alpm.get_package_info(package_name)
-        return pkg is not {}
-
-    def check_updates(self, dbus_context):
-        """ Check for available updates. """
-        if self.is_authorized(dbus_context):
-            return self._check_updates()
+        if self.catalog_ready:
+            pkg = self.all_packages.get(package_name, {})
         else:
-            return []
+            pkg = self.query.get_package_info(package_name)
+        return bool(pkg)
 
+    @dbus_method
+    @dispatch.authorized(POLKIT_ACTION_ID)
+    def check_updates(self, dbus_context):
+        """ Check for available updates. The list of updates is sent to
+            the frontends in the command_finished signal of the job. """
+        uid = self.get_uuid()
+        self.command_queue.put((uid, 'check_updates', []))
+        return uid
+
+    @dbus_method
+    def get_cached_updates(self):
+        """ Returns the result of the last update check (does not check) """
+        return self.updates
+
+    @dbus_method
+    def get_cached_updates_info(self):
+        """ Same as get_cached_updates, as (name, old version, new version,
+            download size) tuples """
+        return self.updates_info
+
+    @dbus_method
+    @dispatch.authorized(POLKIT_ACTION_ID)
+    @dispatch.threaded(fast_path=lambda self: self._alpm is not None)
     def is_alpm_on(self, dbus_context):
-        if self.is_authorized(dbus_context):
-            return bool(self.alpm)
-        else:
-            return False
+        return bool(self.alpm)
 
+    @dbus_method
+    @dispatch.threaded(fast_path=lambda self, package_name: self.query.is_warm())
     def is_package_installed(self, package_name):
         """ Return if the given package is installed. """
-        return bool(self.alpm.is_package_installed(str(package_name)))
-
+        return bool(self.query.is_package_installed(str(package_name)))
+
+    @dbus_method
+    @dispatch.threaded(fast_path=lambda self, package_names: self.query.is_warm())
+    def get_installed_packages(self, package_names):
+        """ Bulk version of is_package_installed. Returns a dict with the
+            installed version of each package ("" if it is not installed). """
+        return self.query.get_installed_versions([str(x) for x in package_names])
+
+    @dbus_method
+    def get_metrics(self):
+        """ Returns the current value of every metric sample, with the same
+            names as in the node_exporter textfile """
+        return self.metrics.to_dict()
+
+    @dbus_method
+    @dispatch.authorized(POLKIT_ACTION_ID)
     def refresh_alpm(self, dbus_context):
         """ Refreshes alpm databases """
-        if self.is_authorized(dbus_context):
-            uid = self.get_uuid()
-            self.command_queue.put((uid, 'refresh', []))
-            return uid
-        else:
-            return ""
+        uid = self.get_uuid()
+        self.command_queue.put((uid, 'refresh', []))
+        return uid
 
+    @dbus_method
+    @dispatch.authorized(POLKIT_ACTION_ID)
     def install_package(self, package_name, dbus_context):
         """ Install the given package. """
-        if self.is_authorized(dbus_context):
-            uid = self.get_uuid()
-            self.command_queue.put((uid, 'install', [package_name]))
-            return uid
-        else:
-            return ""
+        uid = self.get_uuid()
+        self.command_queue.put((uid, 'install', [package_name]))
+        self._preempt_prefetch()
+        return uid
 
+    @dbus_method
+    @dispatch.authorized(POLKIT_ACTION_ID)
     def remove_package(self, package_name, dbus_context):
         """ Uninstall the given package. """
-        if self.is_authorized(dbus_context):
-            uid = self.get_uuid()
-            self.command_queue.put((uid, 'remove', [package_name]))
-            return uid
-        else:
-            return ""
+        uid = self.get_uuid()
+        self.command_queue.put((uid, 'remove', [package_name]))
+        self._preempt_prefetch()
+        return uid
 
+    @dbus_method
+    @dispatch.authorized(POLKIT_ACTION_ID)
     def install_packages(self, package_names, dbus_context):
         """ Install updates """
-        if self.is_authorized(dbus_context):
-            uid = self.get_uuid()
-            self.command_queue.put(
-                (uid, 'install_packages', list(package_names)))
-            return uid
-        else:
-            return ""
-
+        uid = self.get_uuid()
+        self.command_queue.put(
+            (uid, 'install_packages', list(package_names)))
+        self._preempt_prefetch()
+        return uid
+
+    @dbus_method
+    @dispatch.authorized(POLKIT_ACTION_ID)
     def system_upgrade(self, dbus_context):
         """ Install updates """
-        if self.is_authorized(dbus_context):
-            uid = self.get_uuid()
-#            self.command_queue.put((uid, 'refresh', []))
-            self.command_queue.put((uid, 'system_upgrade', []))
-            return uid
-        else:
-            return ""
+        uid = self.get_uuid()
+#        self.command_queue.put((uid, 'refresh', []))
+        self.command_queue.put((uid, 'system_upgrade', []))
+        with self._running_lock:
+            if [job[1] for job in self._running_jobs] == ['prefetch']:
+                # User is waiting for these downloads now
+                priority.set_thread_priority(self._worker_tid, low=False)
+                tx_pid = self.tx_process.pid
+                if tx_pid is not None:
+                    priority.set_process_priority(tx_pid, low=False)
+        return uid
+
+    def _preempt_prefetch(self):
+        """ Interrupts a background download (prefetch) so the job just
+            queued doesn't wait for it. The worker queues it again. """
+        with self._running_lock:
+            if [job[1] for job in self._running_jobs] == ['prefetch']:
+                if self.tx_process.interrupt():
+                    logging.info("Background download interrupted")
+                    self._prefetch_preempted = True
+
+    @dbus_method
+    @dispatch.authorized(POLKIT_ACTION_ID)
+    def clean_cache(self, dbus_context):
+        """ Removes old packages from the package cache """
+        uid = self.get_uuid()
+        self.command_queue.put((uid, 'clean_cache', []))
+        return uid
+
+    @dbus_method
+    @dispatch.authorized(POLKIT_ACTION_ID)
+    def cancel_job(self, uid, dbus_context):
+        """ Removes a queued job, or interrupts it if it is already running.
+            Returns True if the job has been cancelled. """
+        if not uid:
+            # Internal jobs (without uid) can't be cancelled
+            return False
+        with self._running_lock:
+            if self.command_queue.remove(uid):
+                logging.info("Job %s removed from queue", uid)
+                return True
+            running_uids = [job[0] for job in self._running_jobs]
+            if running_uids == [uid]:
+                # Only interrupt the transaction if no other job shares it
+                logging.info("Interrupting job %s", uid)
+                self.alpm.interrupt()
+                self.tx_process.interrupt()
+                return True
+        return False
 
+    @dbus_method
+    @dispatch.authorized(POLKIT_ACTION_ID)
     def exit(self, dbus_context):
-        if self.is_authorized(dbus_context) and self.mainloop:
+        if self.mainloop:
             self.mainloop.quit()
 
+    # Idle exit ----------------------------------------------------------------
+
+    def _is_busy(self):
+        """ True while there are jobs or alpm is being used """
+        with self._running_lock:
+            if self._running_jobs:
+                return True
+        return not self.command_queue.empty() or self.lock.locked()
+
+    def _on_idle(self):
+        """ Releases the bus name, so the next method call starts us again
+            (D-Bus activation) instead of reaching a daemon that is about
+            to quit. Quits once the calls already taken have been answered. """
+        logging.info("Idle for %d seconds, exiting", self.idle_monitor.timeout)
+        if self.publication is None:
+            self._quit()
+            return
+
+        def drain():
+            self.publication.wait()
+            GLib.idle_add(self._quit)
+
+        self.publication.unpublish()
+        thread = threading.Thread(target=drain)
+        thread.daemon = True
+        thread.start()
+
+    def _quit(self):
+        """ Saves what is worth keeping and quits """
+        if self.metrics_textfile:
+            self.metrics.write_textfile(self.metrics_textfile)
+        if self._alpm is not None:
+            try:
+                self._alpm.shutdown()
+            except Exception as general_error:
+                logging.error(general_error)
+        if self.mainloop:
+            self.mainloop.quit()
+        return False
+
+    # Metrics ------------------------------------------------------------------
+
+    def _create_metrics(self):
+        registry = metrics.Metrics()
+        registry.histogram(
+            'welcomed_method_duration_seconds',
+            "Time from the arrival of a D-Bus method call to its reply.")
+        registry.gauge(
+            'welcomed_queue_depth', "Jobs waiting in the command queue.",
+            lambda: self.command_queue.qsize())
+        registry.gauge(
+            'welcomed_running_jobs', "Jobs being run right now.",
+            lambda: len(self._running_jobs))
+        registry.histogram(
+            'welcomed_queue_wait_seconds', "Time jobs spend in the command queue.")
+        registry.histogram(
+            'welcomed_job_duration_seconds', "Time spent running jobs, by command.",
+            metrics.DURATION_BUCKETS)
+        registry.counter(
+            'welcomed_downloads_total', "Finished downloads, by result.")
+        registry.counter(
+            'welcomed_download_bytes_total', "Bytes downloaded.")
+        registry.counter(
+            'welcomed_download_seconds_total', "Time spent downloading.")
+        registry.histogram(
+            'welcomed_download_throughput_bytes_per_second', "Speed of each download.",
+            metrics.THROUGHPUT_BUCKETS)
+        registry.histogram(
+            'welcomed_polkit_check_seconds', "Time polkit took to answer, by result.")
+        registry.counter(
+            'welcomed_polkit_cache_hits_total', "Authorizations found in the cache.")
+        return registry
+
+    def observe_call(self, method_name, seconds):
+        """ Called by dispatch.py after each method call """
+        self.metrics.observe('welcomed_method_duration_seconds', seconds, method=method_name)
+
+    def _on_job_dequeued(self, job, seconds):
+        self.metrics.observe('welcomed_queue_wait_seconds', seconds, command=job[1])
+
+    def _on_transfer(self, url, nbytes, seconds, ok):
+        """ A download has finished (here or in the transaction process) """
+        self.metrics.inc('welcomed_downloads_total', result='ok' if ok else 'failed')
+        if not ok:
+            return
+        self.metrics.inc('welcomed_download_bytes_total', nbytes)
+        self.metrics.inc('welcomed_download_seconds_total', seconds)
+        if nbytes >= mirrors.MIN_MEASURE_BYTES and seconds > 0:
+            self.metrics.observe(
+                'welcomed_download_throughput_bytes_per_second', nbytes / seconds)
+
     # DBus signals -------------------------------------------------------------
     @property
     def command_finished(self):
@@ -228,141 +581,368 @@ class DBusService(object):
         self.PropertiesChanged("com.antergos.welcome", {
                                "command_finished": self.command_finished}, [])
 
+    @property
+    def catalog_ready(self):
+        """ True when package metadata is served from all_packages """
+        return self._catalog_ready
+
+    @catalog_ready.setter
+    def catalog_ready(self, value):
+        self._catalog_ready = value
+        logging.debug("catalog_ready: %s", value)
+        self.PropertiesChanged("com.antergos.welcome", {
+                               "catalog_ready": self.catalog_ready}, [])
+
     PropertiesChanged = signal()
 
+    progress = signal()
+
+    def _emit_progress(self, uid, phase, package, done, total, percent):
+        self.progress(uid, phase, package, done, total, percent)
+
+    def _on_alpm_progress(self, phase, package, done, total, percent):
+        """ Called by Pac from the worker thread while running a job """
+        for job in self._running_jobs:
+            if not job[0]:
+                # Internal job
+                continue
+            self.progress_throttle.report(
+                job[0], phase, str(package or ""), max(int(done), 0),
+                max(int(total), 0), float(percent))
+
+    # Package metadata catalog -------------------------------------------------
+
+    def warm_catalog(self):
+        """ Fills all_packages in a background thread """
+        self._catalog_generation += 1
+        if self.catalog_ready:
+            self.catalog_ready = False
+        t = threading.Thread(target=self._warm_catalog,
+                             args=(self._catalog_generation,))
+        t.daemon = True
+        t.start()
+
+    def _warm_catalog(self, generation):
+        start_time = time.time()
+
+        # Try first the snapshot stored on disk (no need to touch libalpm)
+        packages = self.catalog_snapshot.load()
+        if packages is not None and generation == self._catalog_generation:
+            self.all_packages = packages
+            logging.debug("Package catalog loaded from snapshot (%d packages) in %.2fs",
+                          len(packages), time.time() - start_time)
+            self.catalog_ready = True
+            return
+
+        if generation != self._catalog_generation:
+            # A newer warm up has been requested
+            return
+        # Taken before reading: if a refresh replaces the databases
+        # meanwhile, the snapshot is saved as stale
+        key = self.catalog_snapshot.get_key()
+        try:
+            packages = self.query.get_packages_info()
+        except Exception as general_error:
+            logging.error("Cannot load package catalog: %s", general_error)
+            return
+        if generation == self._catalog_generation:
+            self.all_packages = packages
+            logging.debug("Package catalog loaded (%d packages) in %.2fs",
+                          len(packages), time.time() - start_time)
+            self.catalog_ready = True
+            self.catalog_snapshot.save(packages, key)
+
     # Internal alpm methods ----------------------------------------------------
 
     def _check_updates(self):
-        """ Check for available updates. """
-        updates = self.alpm.check_updates()
+        """ Check for available updates (only if the cached result is stale) """
+        if self.updates_checked_at is not None and \
+                time.monotonic() - self.updates_checked_at < self.updates_ttl:
+            logging.debug("Using cached updates list")
+            return self.updates
+        with self.lock:
+            try:
+                updates_info = self.alpm.get_updates()
+            except Exception as general_error:
+                logging.error(general_error)
+                return self.updates
+        updates = ["{0} {1} -> {2}".format(name, old_version, new_version)
+                   for name, old_version, new_version, size in updates_info]
         logging.info(updates)
-        if not updates:
-            updates = []
+        self.updates = updates
+        self.updates_info = updates_info
+        self.updates_available = len(updates) > 0
+        self.updates_checked_at = time.monotonic()
         return updates
 
+    def _invalidate_updates(self):
+        self.updates_checked_at = None
+
+    def _databases_changed(self):
+        """ Called after a job modifies the local or the sync databases """
+        self._invalidate_updates()
+        self.query.invalidate()
+
     def _refresh_alpm(self):
+        """ Returns a dict repo -> 'fetched', 'skipped' or 'failed' """
         with self.lock:
             logging.info("Refreshing databases...")
             try:
-                self.alpm.refresh()
+                if self.probe_mirrors:
+                    self.alpm.probe_mirrors()
+                if self.alpm.refresh(parallel=True):
+                    return self.alpm.last_refresh_results
+                results = dict(self.alpm.last_refresh_results)
+                if self.alpm.cancel_requested:
+                    logging.info("Refresh cancelled")
+                    return results
+                # Nothing at all if the parallel refresh could not start
+                failed = [repo for repo, result in results.items() if result == 'failed']
+                logging.warning("Parallel refresh failed (%s), trying again serially",
+                                ", ".join(failed) or "all repos")
+                self.alpm.refresh(repos=failed or None)
+                results.update(self.alpm.last_refresh_results)
+                return results
             except Exception as general_error:
                 logging.error(general_error)
+            # Don't know what libalpm did, assume everything has changed
+            return dict((repo, 'fetched') for repo in self.config.repos)
 
-    def _install_package(self, package):
-        with self.lock:
-            logging.info("Installing %s", package)
+    def _run_transaction(self, command, packages=()):
+        """ Runs a libalpm transaction in a child process (see txworker.py)
+            and reloads what it may have changed. Returns True if it worked. """
+        try:
+            return self.tx_process.run(
+                command, packages, logging.getLogger().getEffectiveLevel())
+        except Exception as general_error:
+            logging.error(general_error)
+            return False
+        finally:
             try:
-                self.alpm.install([str(package)])
+                self.alpm.mirror_stats.reload()
+                if command == 'prefetch':
+                    # Only the package cache has changed
+                    self.alpm.rank_mirrors()
+                else:
+                    self.alpm.reload()
             except Exception as general_error:
                 logging.error(general_error)
 
-    def _remove_package(self, package):
+    def _remove_packages(self, packages):
         with self.lock:
-            logging.info("Removing %s", package)
-            try:
-                self.alpm.remove([str(package)])
-            except Exception as general_error:
-                logging.error(general_error)
+            logging.info("Removing %s", packages)
+            return self._run_transaction('remove', packages)
 
     def _install_packages(self, packages):
         with self.lock:
             logging.info("Installing %s", packages)
-            try:
-                self.alpm.install(packages)
-            except Exception as general_error:
-                logging.error(general_error)
+            return self._run_transaction('install', packages)
+
+    def _run_merged(self, run, jobs):
+        """ Runs the packages of all jobs in one transaction (run(packages)).
+            If it fails, each job is run again on its own, so one bad
+            package doesn't make the jobs queued with it fail too. """
+        if run(self._merge_packages(jobs)) or len(jobs) == 1:
+            return
+        logging.warning("Merged transaction failed, running its %d jobs one at a time",
+                        len(jobs))
+        for job in jobs:
+            if self.alpm.cancel_requested:
+                break
+            run(self._merge_packages([job]))
 
     def _system_upgrade(self):
         with self.lock:
             logging.info("Full system upgrade...")
+            self._run_transaction('system_upgrade')
+
+    def _prefetch_upgrades(self):
+        """ Downloads pending updates at low CPU and I/O priority """
+        with self.lock:
+            logging.info("Downloading updates in the background...")
+            tid = threading.get_native_id()
+            priority.set_thread_priority(tid, low=True)
+            try:
+                # The child process inherits our priority
+                self._run_transaction('prefetch')
+            finally:
+                priority.set_thread_priority(tid, low=False)
+
+    def _clean_cache(self):
+        """ Returns the list of removed files """
+        with self.lock:
+            logging.info("Cleaning package cache...")
+            tid = threading.get_native_id()
+            priority.set_thread_priority(tid, low=True)
+            max_bytes = self.cache_budget * 1024 * 1024 if self.cache_budget > 0 else None
             try:
-                self.alpm.system_upgrade()
+                removed, freed = self.alpm.clean_cache(self.cache_keep, max_bytes)
             except Exception as general_error:
                 logging.error(general_error)
+                removed = []
+            finally:
+                priority.set_thread_priority(tid, low=False)
+        return removed
+
+    def _get_jobs(self):
+        """ Gets the next job from the queue, together with the jobs queued
+            right after it that can run in the same transaction. """
+        first = self.command_queue.get()
+        jobs = [first]
+        group = COALESCE_GROUPS.get(first[1])
+        if group is None:
+            return jobs
+        while True:
+            job = self.command_queue.get_next_if(
+                lambda next_job: COALESCE_GROUPS.get(next_job[1]) == group)
+            if job is None:
+                break
+            jobs.append(job)
+        return jobs
 
     def _command_queue_worker(self):
+        self._worker_tid = threading.get_native_id()
         while True:
-            if self.lock_ok():
-                uid, command, packages = self.command_queue.get()
-                if command == 'install':
-                    self._install_package(packages[0])
-                    # Send signal to frontends
-                    self.command_finished = (uid, command, packages)
-                elif command == 'install_packages':
-                    self._install_packages(packages)
-                    self.command_finished = (uid, command, packages)
-                elif command == 'remove':
-                    self._remove_package(packages[0])
-                    self.command_finished = (uid, command, packages)
-                elif command == 'refresh':
-                    self._refresh_alpm()
-                    self.command_finished = (uid, command, packages)
-                elif command == 'check_updates':
-                    output = self._check_updates()
-                    self.command_finished = (uid, command, packages)
-                elif command == 'system_upgrade':
-                    self._system_upgrade()
-                    self.command_finished = (uid, command, packages)
-                elif command == 'frontend_loaded':
-                    self._do_frontend_loaded()
-                    self.command_finished = (uid, command, packages)
-                else:
-                    logging.error(_("Unknown command %s"), command)
+            jobs = self._get_jobs()
+            if self.alpm is None:
+                logging.error("Alpm library is not available, dropping %d jobs", len(jobs))
+                # Tell frontends, so they don't wait forever
+                for job in jobs:
+                    if job[0]:
+                        self.progress_throttle.forget(job[0])
+                        self.command_finished = (job[0], job[1], [ALPM_UNAVAILABLE])
+                continue
+            with self._running_lock:
+                self._running_jobs = jobs
+                self.alpm.reset_interrupt()
+                self.tx_process.reset_interrupt()
+                self._prefetch_preempted = False
+            while not self.lock_ok():
+                # Someone else (pacman) is using the databases
+                pass
+            uid, command, packages = jobs[0]
+            if self.alpm.cancel_requested:
+                logging.info("Job %s cancelled before it started", uid)
+                self._running_jobs = []
+                continue
+            group = COALESCE_GROUPS.get(command)
+            if len(jobs) > 1:
+                logging.debug("Running %d '%s' jobs in one transaction",
+                              len(jobs), group)
+            start_time = time.monotonic()
+            if group == 'install':
+                self._run_merged(self._install_packages, jobs)
+                self._databases_changed()
+            elif group == 'remove':
+                self._run_merged(self._remove_packages, jobs)
+                self._databases_changed()
+            elif group == 'refresh':
+                results = self._refresh_alpm()
+                if 'fetched' in results.values():
+                    self._databases_changed()
+                    self.warm_catalog()
+                # Tell frontends which repos have been downloaded
+                results = ["{0}:{1}".format(repo, result)
+                           for repo, result in results.items()]
+                jobs = [(job[0], job[1], results) for job in jobs]
+            elif group == 'check_updates':
+                updates = self._check_updates()
+                # Send the updates list in the signal
+                jobs = [(job[0], job[1], updates) for job in jobs]
+                if self.prefetch and updates and not self._prefetch_queued:
+                    # Internal job (no uid, frontends are not told about it)
+                    self._prefetch_queued = True
+                    self.command_queue.put(("", 'prefetch', []))
+            elif command == 'prefetch':
+                self._prefetch_queued = False
+                self._prefetch_upgrades()
+                if self._prefetch_preempted and not self._prefetch_queued:
+                    # Go on after the job that interrupted it
+                    self._prefetch_queued = True
+                    self.command_queue.put(("", 'prefetch', []))
+            elif command == 'clean_cache':
+                removed = self._clean_cache()
+                jobs = [(job[0], job[1], removed) for job in jobs]
+            elif command == 'system_upgrade':
+                self._system_upgrade()
+                self._databases_changed()
+            elif command == 'frontend_loaded':
+                self._do_frontend_loaded()
+            else:
+                logging.error(_("Unknown command %s"), command)
+                self._running_jobs = []
+                continue
+            self.metrics.observe('welcomed_job_duration_seconds',
+                                 time.monotonic() - start_time, command=group or command)
+            with self._running_lock:
+                self._running_jobs = []
+            # Send signal to frontends (one for each job)
+            for job in jobs:
+                if not job[0]:
+                    continue
+                self.progress_throttle.forget(job[0])
+                self.command_finished = job
+
+    @staticmethod
+    def _merge_packages(jobs):
+        """ Package names of all jobs, without duplicates """
+        packages = []
+        for uid, command, job_packages in jobs:
+            for package in map(str, job_packages):
+                if package not in packages:
+                    packages.append(package)
+        return packages
 
     # Polkit -------------------------------------------------------------------
 
-    def is_authorized(self, dbus_context, interactive=True):
-        action_id = "com.antergos.welcome.install"
-        details = {
-            'polkit.icon': 'antergos-welcome',
-            'polkit.message': 'antergos-welcome'}
+    def authorize(self, connection, sender, action_id, callback):
+        """ Calls callback(authorized) once polkit has answered. Used by
+            dispatch.py for methods marked with @dispatch.authorized, which
+            wait (without blocking anything) until then. """
+        # Don't exit on idle while a password dialog is open
+        self.idle_monitor.touch(sender)
+        if self.auth_cache.is_granted(sender, action_id):
+            self.metrics.inc('welcomed_polkit_cache_hits_total')
+            callback(True)
+            return
+
+        key = (sender, action_id)
+        if key in self.pending_auth:
+            # Already asked (maybe a password dialog is open). Share its answer.
+            self.pending_auth[key].append(callback)
+            return
+        self.pending_auth[key] = [callback]
+        start_time = time.monotonic()
+
+        def on_result(authorized):
+            self.metrics.observe(
+                'welcomed_polkit_check_seconds', time.monotonic() - start_time,
+                result='granted' if authorized else 'denied')
+            if authorized:
+                self.auth_cache.grant(sender, action_id)
+            for waiting in self.pending_auth.pop(key, []):
+                waiting(authorized)
 
-        return dbus_context.check_authorization(action_id, details, interactive=True)
+        try:
+            polkit.check_authorization(
+                connection, sender, action_id, POLKIT_DETAILS, on_result, interactive=True)
+        except Exception:
+            del self.pending_auth[key]
+            raise
+
+    def _on_name_owner_changed(self, sender, object_path, iface, signal_name, params):
+        """ Forget authorizations of clients that leave the bus """
+        name, old_owner, new_owner = params
+        if old_owner and not new_owner:
+            self.auth_cache.forget(old_owner)
+            self.idle_monitor.forget_client(old_owner)
 
     # db.lck -------------------------------------------------------------------
 
     def lock_ok(self):
-        if self._is_lock_available():
-            return True
-        # Lock exists, we will try to acquire it (waiting)
-        if self._acquire_lock():
-            # Yes! We got it! Delete it.
-            self._release_lock()
+        """ Waits (up to lock_timeout seconds) for pacman's db.lck to be
+            released. Returns True if it is free. """
+        if self.db_lock.wait(self.lock_timeout):
             return True
         logging.error("db.lck exists and is owned by another process!")
         return False
-
-    def _is_lock_available(self):
-        """ Returns True if the file is currently available to be locked. """
-        return not os.path.exists(self.lock_file)
-
-    def _acquire_lock(self, delay=1, timeout=10):
-        """
-        Acquire the lock, if possible. Otherwise, check again every `delay`
-        seconds until it either gets the lock or exceeds `timeout` number of
-        seconds.
-        """
-        start_time = time.time()
-        while True:
-            try:
-                # Attempt to create the lockfile.
-                # These flags cause os.open to raise an OSError if the file already exists.
-                fd = os.open(self.lock_file, os.O_CREAT |
-                             os.O_EXCL | os.O_RDWR)
-                break
-            except OSError as err:
-                if err.errno != errno.EEXIST:
-                    logging.error("Cannot acquire lock!")
-                    return False
-                if (time.time() - start_time) >= timeout:
-                    logging.error("Lock timeout!")
-                    return False
-                # wait delay seconds and try again
-                time.sleep(delay)
-        self.is_locked = True
-        return True
-
-    def _release_lock(self):
-        """ Get rid of the lock by deleting the lockfile. """
-        self.is_locked = False
-        os.unlink(self.lockfile)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_cachemgr.py
+#
+#  Copyright © 2015-2017 Antergos
+#
+#  This file is part of antergos-welcome
+#
+#  Antergos-welcome is free software: you can redistribute it and/or modify
+#  it under the temms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Antergos-welcome is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Antergos-welcome. If not, see <http://www.gnu.org/licenses/>.
+
+""" Tests of pacman/cachemgr.py on a temporary package cache
+
+    Run from src/welcomed with: python -m unittest discover tests
+"""
+
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pacman import cachemgr
+
+
+def _vercmp(a, b):
+    """ Enough of pyalpm.vercmp for the versions used here """
+    def key(version):
+        return [int(part) for part in re.split(r'[.-]', version)]
+    return (key(a) > key(b)) - (key(a) < key(b))
+
+
+class ParsePkgFilenameTest(unittest.TestCase):
+
+    def test_package(self):
+        self.assertEqual(cachemgr.parse_pkg_filename("bash-5.0.007-1-x86_64.pkg.tar.xz"),
+                         ("bash", "5.0.007-1", "x86_64"))
+
+    def test_name_with_dashes(self):
+        self.assertEqual(
+            cachemgr.parse_pkg_filename("python-gobject-3.30.4-1-x86_64.pkg.tar.zst"),
+            ("python-gobject", "3.30.4-1", "x86_64"))
+
+    def test_epoch(self):
+        self.assertEqual(cachemgr.parse_pkg_filename("vim-2:8.1.0-1-x86_64.pkg.tar"),
+                         ("vim", "2:8.1.0-1", "x86_64"))
+
+    def test_not_a_package(self):
+        for filename in ("bash-5.0.007-1-x86_64.pkg.tar.xz.sig",
+                         "core.db", "bash-x86_64.pkg.tar.xz", "download-XXXX.part"):
+            self.assertIsNone(cachemgr.parse_pkg_filename(filename), filename)
+
+
+class CacheManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cachedir)
+        self.now = time.time()
+
+    def _add(self, name, version, size=100, read_in=None, sig=False):
+        """ Adds a downloaded package (mtime is the server's Last-Modified).
+            If read_in is given, it is read read_in seconds from now. """
+        filename = "{0}-{1}-x86_64.pkg.tar.xz".format(name, version)
+        path = os.path.join(self.cachedir, filename)
+        with open(path, 'wb') as pkg_file:
+            pkg_file.write(b'\0' * size)
+        if sig:
+            with open(path + ".sig", 'wb') as sig_file:
+                sig_file.write(b'\0' * 10)
+        modified = self.now - 10 ** 6
+        read = self.now + read_in if read_in is not None else modified
+        os.utime(path, (read, modified))
+        return filename
+
+    def _evictions(self, installed, keep_versions=3, max_bytes=None, vercmp=_vercmp):
+        manager = cachemgr.CacheManager([self.cachedir], keep_versions, max_bytes, vercmp)
+        evict, kept_bytes = manager.get_evictions(installed)
+        return sorted(os.path.basename(pkg.path) for pkg in evict), kept_bytes
+
+    def test_keep_versions(self):
+        old = [self._add("foo", "1.{}-1".format(minor)) for minor in range(5)]
+        evict, kept_bytes = self._evictions({}, keep_versions=2)
+        self.assertEqual(evict, sorted(old[:3]))
+        self.assertEqual(kept_bytes, 200)
+
+    def test_installed_is_kept(self):
+        installed = self._add("foo", "1.0-1")
+        for minor in range(1, 4):
+            self._add("foo", "0.{}-1".format(minor))
+        evict, kept_bytes = self._evictions({"foo": "1.0-1"}, keep_versions=0)
+        self.assertNotIn(installed, evict)
+        self.assertEqual(len(evict), 3)
+
+    def test_installed_is_kept_over_budget(self):
+        self._add("foo", "1.0-1", size=1000)
+        evict, kept_bytes = self._evictions({"foo": "1.0-1"}, max_bytes=10)
+        self.assertEqual(evict, [])
+        self.assertEqual(kept_bytes, 1000)
+
+    def test_budget_least_recently_used_first(self):
+        recent = self._add("foo", "1.0-1", read_in=1000)
+        old = self._add("bar", "1.0-1", read_in=500)
+        # Only its arrival (ctime, now)
+        older = self._add("baz", "1.0-1")
+        evict, kept_bytes = self._evictions({}, max_bytes=150)
+        self.assertEqual(evict, sorted([old, older]))
+        self.assertEqual(kept_bytes, 100)
+        self.assertNotIn(recent, evict)
+
+    def test_signature_counts(self):
+        self._add("foo", "1.0-1", sig=True)
+        evict, kept_bytes = self._evictions({})
+        self.assertEqual(kept_bytes, 110)
+
+    def test_pending_upgrade_is_kept(self):
+        self._add("foo", "1.0-1", read_in=1000)
+        # Prefetched, never read
+        self._add("foo", "1.1-1")
+        evict, kept_bytes = self._evictions({"foo": "1.0-1"}, max_bytes=0)
+        self.assertEqual(evict, [])
+
+    def test_arrival_counts_as_use(self):
+        # Old mtime and atime (server's Last-Modified) but just arrived
+        self._add("foo", "1.0-1")
+        self._add("bar", "1.0-1")
+        manager = cachemgr.CacheManager([self.cachedir])
+        for pkgs in manager.scan().values():
+            self.assertGreaterEqual(pkgs[0].last_used, self.now - 60)
+
+    def test_clean(self):
+        old = self._add("foo", "1.0-1", sig=True)
+        new = self._add("foo", "1.1-1")
+        manager = cachemgr.CacheManager([self.cachedir], 1, None, _vercmp)
+        removed, freed = manager.clean({})
+        self.assertEqual(removed, [old])
+        self.assertEqual(freed, 110)
+        self.assertEqual(os.listdir(self.cachedir), [new])
+
+    def test_dry_run(self):
+        self._add("foo", "1.0-1")
+        self._add("foo", "1.1-1")
+        manager = cachemgr.CacheManager([self.cachedir], 1, None, _vercmp)
+        removed, freed = manager.clean({}, dry_run=True)
+        self.assertEqual(len(removed), 1)
+        self.assertEqual(len(os.listdir(self.cachedir)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_dbsync.py
+#
+#  Copyright © 2015-2017 Antergos
+#
+#  This file is part of antergos-welcome
+#
+#  Antergos-welcome is free software: you can redistribute it and/or modify
+#  it under the temms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Antergos-welcome is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Antergos-welcome. If not, see <http://www.gnu.org/licenses/>.
+
+""" Tests of pacman/dbsync.py against local http servers
+
+    Run from src/welcomed with: python -m unittest discover tests
+"""
+
+import functools
+import http.server
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pacman import dbsync
+from pacman import hedge
+
+# Fixture databases served by the mirrors
+FIXTURES = {
+    'core.db': b'core database\n' * 1024,
+    'core.db.sig': b'core signature\n',
+    'extra.db': b'extra database\n' * 4096}
+
+
+class _RepoHandler(http.server.SimpleHTTPRequestHandler):
+    """ Serves a directory, remembering the status of every request """
+
+    def __init__(self, *args, mirror=None, **kwargs):
+        self.mirror = mirror
+        super(_RepoHandler, self).__init__(*args, directory=mirror.directory, **kwargs)
+
+    def do_GET(self):
+        self.mirror.if_none_match.append((self.path, self.headers.get('If-None-Match')))
+        if self.mirror.stall:
+            # Accepts the request but never answers in time
+            time.sleep(self.mirror.stall)
+        super(_RepoHandler, self).do_GET()
+
+    def end_headers(self):
+        if self.mirror.etag:
+            self.send_header('ETag', self.mirror.etag)
+        super(_RepoHandler, self).end_headers()
+
+    def log_request(self, code='-', size='-'):
+        self.mirror.requests.append((self.path, int(code)))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Mirror(object):
+    """ http server on localhost serving directory """
+
+    def __init__(self, directory, stall=0, etag=None):
+        self.directory = directory
+        self.stall = stall
+        self.etag = etag
+        self.requests = []
+        # (path, If-None-Match header) of each request
+        self.if_none_match = []
+        handler = functools.partial(_RepoHandler, mirror=self)
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        self.url = "http://127.0.0.1:{}".format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def statuses(self, path):
+        return [code for request_path, code in self.requests if request_path == path]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class DatabaseSyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.repo_dir = os.path.join(self.tmp_dir, 'repo')
+        self.empty_dir = os.path.join(self.tmp_dir, 'empty')
+        self.sync_path = os.path.join(self.tmp_dir, 'sync')
+        self.state_path = os.path.join(self.tmp_dir, 'state', 'dbsync.json')
+        for path in (self.repo_dir, self.empty_dir, self.sync_path):
+            os.mkdir(path)
+        for name, data in FIXTURES.items():
+            with open(os.path.join(self.repo_dir, name), 'wb') as fixture:
+                fixture.write(data)
+        # Old enough for If-Modified-Since to be exact (http dates have no fractions)
+        old = int(time.time()) - 3600
+        for name in FIXTURES:
+            os.utime(os.path.join(self.repo_dir, name), (old, old))
+
+        # Requests to our servers must not go through a proxy
+        environ = mock.patch.dict(os.environ, {'no_proxy': '*'})
+        environ.start()
+        self.addCleanup(environ.stop)
+
+        self.mirrors = []
+        self.transfers = []
+
+    def tearDown(self):
+        for mirror in self.mirrors:
+            mirror.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _mirror(self, directory=None, stall=0, etag=None):
+        mirror = _Mirror(directory or self.repo_dir, stall, etag)
+        self.mirrors.append(mirror)
+        return mirror
+
+    def _syncer(self, min_age=0, hedge_delay=0, cancelled=None):
+        return dbsync.DatabaseSync(
+            self.sync_path, min_age=min_age, state_path=self.state_path,
+            hedge_delay=hedge_delay, timeout=5, cancelled=cancelled,
+            transfer_callback=lambda *transfer: self.transfers.append(transfer))
+
+    def _read(self, name):
+        with open(os.path.join(self.sync_path, name), 'rb') as db_file:
+            return db_file.read()
+
+    def test_fetched(self):
+        mirror = self._mirror()
+        results = self._syncer().sync({'core': [mirror.url], 'extra': [mirror.url]})
+        self.assertEqual(results, {'core': dbsync.FETCHED, 'extra': dbsync.FETCHED})
+        for name in FIXTURES:
+            self.assertEqual(self._read(name), FIXTURES[name])
+        # Server's mtime is kept
+        self.assertEqual(os.path.getmtime(os.path.join(self.sync_path, 'core.db')),
+                         os.path.getmtime(os.path.join(self.repo_dir, 'core.db')))
+        # No leftovers
+        self.assertEqual(sorted(os.listdir(self.sync_path)), sorted(FIXTURES))
+
+    def test_not_modified(self):
+        mirror = self._mirror()
+        self._syncer().sync({'core': [mirror.url]})
+        results = self._syncer().sync({'core': [mirror.url]})
+        self.assertEqual(results, {'core': dbsync.SKIPPED})
+        self.assertEqual(mirror.statuses('/core.db'), [200, 304])
+        self.assertEqual(self._read('core.db'), FIXTURES['core.db'])
+        # Signature is kept, not removed as if the database had changed
+        self.assertEqual(self._read('core.db.sig'), FIXTURES['core.db.sig'])
+
+    def test_forced(self):
+        mirror = self._mirror()
+        self._syncer().sync({'core': [mirror.url]})
+        results = self._syncer().sync({'core': [mirror.url]}, force=True)
+        self.assertEqual(results, {'core': dbsync.FETCHED})
+        self.assertEqual(mirror.statuses('/core.db'), [200, 200])
+
+    def test_etag_per_server(self):
+        first = self._mirror(etag='"first"')
+        second = self._mirror()
+        self._syncer().sync({'core': [first.url]})
+        self._syncer().sync({'core': [second.url]})
+        self._syncer().sync({'core': [first.url]})
+        # Only the server that gave the ETag gets it back
+        self.assertEqual(second.if_none_match, [('/core.db', None)])
+        self.assertEqual([etag for path, etag in first.if_none_match if path == '/core.db'],
+                         [None, '"first"'])
+
+    def test_min_age(self):
+        mirror = self._mirror()
+        self._syncer(min_age=3600).sync({'core': [mirror.url]})
+        results = self._syncer(min_age={'core': 3600, 'default': 0}).sync(
+            {'core': [mirror.url], 'extra': [mirror.url]})
+        self.assertEqual(results, {'core': dbsync.SKIPPED, 'extra': dbsync.FETCHED})
+        # core was not even asked
+        self.assertEqual(mirror.statuses('/core.db'), [200])
+        self.assertEqual(mirror.statuses('/extra.db'), [200])
+
+    def test_min_age_needs_database(self):
+        mirror = self._mirror()
+        self._syncer(min_age=3600).sync({'core': [mirror.url]})
+        os.unlink(os.path.join(self.sync_path, 'core.db'))
+        results = self._syncer(min_age=3600).sync({'core': [mirror.url]})
+        self.assertEqual(results, {'core': dbsync.FETCHED})
+
+    def test_failover(self):
+        broken = self._mirror(self.empty_dir)
+        mirror = self._mirror()
+        results = self._syncer().sync({'core': [broken.url, mirror.url]})
+        self.assertEqual(results, {'core': dbsync.FETCHED})
+        self.assertEqual(self._read('core.db'), FIXTURES['core.db'])
+        self.assertEqual(broken.statuses('/core.db'), [404])
+        self.assertIn((broken.url + '/core.db', False),
+                      [(url, ok) for url, nbytes, seconds, ok in self.transfers])
+
+    def test_failover_hedged(self):
+        stalled = self._mirror(stall=2)
+        mirror = self._mirror()
+        start_time = time.monotonic()
+        results = self._syncer(hedge_delay=0.2).sync({'core': [stalled.url, mirror.url]})
+        self.assertEqual(results, {'core': dbsync.FETCHED})
+        self.assertLess(time.monotonic() - start_time, 2)
+        self.assertEqual(self._read('core.db'), FIXTURES['core.db'])
+
+    def test_cancelled(self):
+        mirror = self._mirror()
+        self._syncer().sync({'core': [mirror.url]})
+        with open(os.path.join(self.repo_dir, 'core.db'), 'wb') as fixture:
+            fixture.write(b'new core database\n')
+        slow = self._mirror(stall=0.5)
+        cancelled = hedge.CancelToken()
+        threading.Timer(0.1, cancelled.set).start()
+        results = self._syncer(cancelled=cancelled).sync(
+            {'core': [slow.url], 'extra': [slow.url]}, force=True)
+        self.assertEqual(results, {'core': dbsync.FAILED, 'extra': dbsync.FAILED})
+        # Nothing replaced, nothing left behind
+        self.assertEqual(self._read('core.db'), FIXTURES['core.db'])
+        self.assertEqual(sorted(os.listdir(self.sync_path)), ['core.db', 'core.db.sig'])
+
+    def test_all_failed(self):
+        broken = self._mirror(self.empty_dir)
+        results = self._syncer().sync({'core': [broken.url]})
+        self.assertEqual(results, {'core': dbsync.FAILED})
+        self.assertEqual(os.listdir(self.sync_path), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  txworker.py
+#
+#  Copyright © 2015-2017 Antergos
+#
+#  This file is part of antergos-welcome
+#
+#  Antergos-welcome is free software: you can redistribute it and/or modify
+#  it under the temms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Antergos-welcome is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Antergos-welcome. If not, see <http://www.gnu.org/licenses/>.
+
+""" Runs libalpm transactions in a child process.
+
+    The daemon (TransactionProcess) starts this same file as a script and
+    writes the job to its stdin as a json line. Later lines are commands
+    ("cancel"). The child answers through its stdout with binary frames:
+
+        type (1 byte) | payload length (4 bytes) | payload
+
+    All integers are big endian. Payloads are:
+
+        FRAME_PROGRESS  done (8) | total (8) | percent (double) | phase | package
+        FRAME_LOG       level (2) | message
+        FRAME_RESULT    ok (1) | error message
+        FRAME_TRANSFER  bytes (8) | seconds (double) | ok (1) | url
+
+    Strings are utf-8, preceded by their length (2 bytes, 4 for messages).
+"""
+
+import json
+import logging
+import os
+import struct
+import subprocess
+import sys
+import threading
+
+FRAME_PROGRESS = 1
+FRAME_LOG = 2
+FRAME_RESULT = 3
+FRAME_TRANSFER = 4
+
+_HEADER = struct.Struct('!BI')
+_PROGRESS = struct.Struct('!QQd')
+_LOG = struct.Struct('!H')
+_RESULT = struct.Struct('!B')
+_TRANSFER = struct.Struct('!QdB')
+
+# Jobs the child knows how to run
+COMMANDS = ('install', 'remove', 'system_upgrade', 'prefetch')
+
+# Seconds a child has to stop after being interrupted before it is
+# terminated, and then killed
+INTERRUPT_GRACE = 60
+TERMINATE_GRACE = 10
+
+
+class TransactionProcessError(Exception):
+    """ The child died without sending its result """
+    pass
+
+
+# Framing ----------------------------------------------------------------------
+
+def _pack_str(text, size_format='!H'):
+    data = text.encode('utf-8', 'replace')
+    return struct.pack(size_format, len(data)) + data
+
+
+def _unpack_str(payload, offset, size_format='!H'):
+    size_len = struct.calcsize(size_format)
+    (size,) = struct.unpack_from(size_format, payload, offset)
+    offset += size_len
+    return payload[offset:offset + size].decode('utf-8', 'replace'), offset + size
+
+
+def encode_frame(frame_type, payload):
+    return _HEADER.pack(frame_type, len(payload)) + payload
+
+
+def encode_progress(phase, package, done, total, percent):
+    payload = _PROGRESS.pack(max(int(done), 0), max(int(total), 0), float(percent))
+    payload += _pack_str(phase[:1024]) + _pack_str(package[:1024])
+    return encode_frame(FRAME_PROGRESS, payload)
+
+
+def decode_progress(payload):
+    done, total, percent = _PROGRESS.unpack_from(payload)
+    phase, offset = _unpack_str(payload, _PROGRESS.size)
+    package, offset = _unpack_str(payload, offset)
+    return phase, package, done, total, percent
+
+
+def encode_log(level, message):
+    return encode_frame(FRAME_LOG, _LOG.pack(level) + _pack_str(message, '!I'))
+
+
+def decode_log(payload):
+    (level,) = _LOG.unpack_from(payload)
+    message, offset = _unpack_str(payload, _LOG.size, '!I')
+    return level, message
+
+
+def encode_result(ok, error=""):
+    return encode_frame(FRAME_RESULT, _RESULT.pack(1 if ok else 0) + _pack_str(error, '!I'))
+
+
+def decode_result(payload):
+    (ok,) = _RESULT.unpack_from(payload)
+    error, offset = _unpack_str(payload, _RESULT.size, '!I')
+    return bool(ok), error
+
+
+def encode_transfer(url, nbytes, seconds, ok):
+    payload = _TRANSFER.pack(max(int(nbytes), 0), float(seconds), 1 if ok else 0)
+    return encode_frame(FRAME_TRANSFER, payload + _pack_str(url[:4096]))
+
+
+def decode_transfer(payload):
+    nbytes, seconds, ok = _TRANSFER.unpack_from(payload)
+    url, offset = _unpack_str(payload, _TRANSFER.size)
+    return url, nbytes, seconds, bool(ok)
+
+
+def _read_exactly(stream, size):
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def read_frame(stream):
+    """ Returns (type, payload) or None at the end of the stream """
+    header = _read_exactly(stream, _HEADER.size)
+    if header is None:
+        return None
+    frame_type, size = _HEADER.unpack(header)
+    payload = _read_exactly(stream, size) if size else b''
+    if payload is None:
+        return None
+    return frame_type, payload
+
+
+# Daemon side ------------------------------------------------------------------
+
+class TransactionProcess(object):
+    """ Runs one job in a new child process and waits for it, passing its
+        progress to on_progress(phase, package, done, total, percent), its
+        downloads to on_transfer(url, nbytes, seconds, ok) and its log
+        messages to our logger. A crash of libalpm only kills the child,
+        and the GIL of the daemon is not used by libalpm callbacks.
+        hedge_delay and fetch_workers are passed to the child's Pac.
+
+        A child that doesn't stop within INTERRUPT_GRACE seconds of being
+        interrupted is terminated (and killed if that is not enough). """
+
+    def __init__(self, on_progress=None, on_transfer=None, hedge_delay=3,
+                 fetch_workers=4):
+        self.on_progress = on_progress
+        self.on_transfer = on_transfer
+        self.hedge_delay = hedge_delay
+        self.fetch_workers = fetch_workers
+        self._proc = None
+        # interrupt() called before the child was started
+        self._interrupt_pending = False
+        self._escalation = None
+        self._lock = threading.Lock()
+
+    @property
+    def pid(self):
+        """ pid of the running child (None if there isn't one) """
+        proc = self._proc
+        return proc.pid if proc is not None else None
+
+    def run(self, command, packages=(), log_level=logging.INFO):
+        """ Returns True if the job succeeded. Raises TransactionProcessError
+            if the child dies without answering. """
+        request = {'command': command, 'packages': list(packages), 'log_level': log_level,
+                   'hedge_delay': self.hedge_delay, 'fetch_workers': self.fetch_workers}
+        proc = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+        result = None
+        try:
+            proc.stdin.write((json.dumps(request) + "\n").encode('utf-8'))
+            proc.stdin.flush()
+            with self._lock:
+                self._proc = proc
+                if self._interrupt_pending:
+                    self._interrupt_pending = False
+                    self._send_cancel(proc)
+            while True:
+                frame = read_frame(proc.stdout)
+                if frame is None:
+                    break
+                frame_type, payload = frame
+                if frame_type == FRAME_PROGRESS:
+                    if self.on_progress is not None:
+                        self.on_progress(*decode_progress(payload))
+                elif frame_type == FRAME_LOG:
+                    level, message = decode_log(payload)
+                    logging.log(level, "[transaction] %s", message)
+                elif frame_type == FRAME_TRANSFER:
+                    if self.on_transfer is not None:
+                        self.on_transfer(*decode_transfer(payload))
+                elif frame_type == FRAME_RESULT:
+                    result = decode_result(payload)
+        except OSError as err:
+            logging.error("Lost contact with the transaction process: %s", err)
+        finally:
+            with self._lock:
+                self._proc = None
+                try:
+                    proc.stdin.close()
+                except OSError:
+                    pass
+            returncode = proc.wait()
+            proc.stdout.close()
+            with self._lock:
+                if self._escalation is not None:
+                    self._escalation.cancel()
+                    self._escalation = None
+
+        if result is None:
+            if returncode < 0:
+                raise TransactionProcessError(
+                    "Transaction process killed by signal {}".format(-returncode))
+            raise TransactionProcessError(
+                "Transaction process exited with code {}".format(returncode))
+        ok, error = result
+        if error:
+            logging.error(error)
+        return ok
+
+    def interrupt(self):
+        """ Asks the running child to cancel its transaction. If the child
+            is not running yet, the next one is cancelled as soon as it
+            starts (see reset_interrupt). """
+        with self._lock:
+            if self._proc is None:
+                self._interrupt_pending = True
+                return True
+            return self._send_cancel(self._proc)
+
+    def reset_interrupt(self):
+        """ Forgets an interrupt() that no child has received (called
+            before starting a new job) """
+        with self._lock:
+            self._interrupt_pending = False
+
+    def _send_cancel(self, proc):
+        """ Must be called with _lock held """
+        try:
+            proc.stdin.write(b"cancel\n")
+            proc.stdin.flush()
+        except (OSError, ValueError):
+            return False
+        if self._escalation is None:
+            self._escalation = threading.Timer(INTERRUPT_GRACE, self._terminate, (proc,))
+            self._escalation.daemon = True
+            self._escalation.start()
+        return True
+
+    @staticmethod
+    def _terminate(proc):
+        """ The child has not stopped after being interrupted (hung in libalpm) """
+        if proc.poll() is not None:
+            return
+        logging.warning("Transaction process %d does not stop, terminating it", proc.pid)
+        proc.terminate()
+        try:
+            proc.wait(TERMINATE_GRACE)
+        except subprocess.TimeoutExpired:
+            logging.warning("Killing transaction process %d", proc.pid)
+            proc.kill()
+
+
+# Child side -------------------------------------------------------------------
+
+class _FrameWriter(object):
+    """ Writes whole frames to fd (libalpm callbacks come from several threads) """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self._lock = threading.Lock()
+
+    def write(self, frame):
+        with self._lock:
+            view = memoryview(frame)
+            while view:
+                written = os.write(self.fd, view)
+                view = view[written:]
+
+
+class _FrameLogHandler(logging.Handler):
+    def __init__(self, writer):
+        super(_FrameLogHandler, self).__init__()
+        self.writer = writer
+
+    def emit(self, record):
+        try:
+            self.writer.write(encode_log(record.levelno, self.format(record)))
+        except Exception:
+            self.handleError(record)
+
+
+def _read_commands(alpm):
+    for line in sys.stdin:
+        if line.strip() == "cancel":
+            alpm.interrupt()
+
+
+def child_main():
+    # Frames use the real stdout. Anything else printed goes to stderr.
+    writer = _FrameWriter(os.dup(1))
+    os.dup2(2, 1)
+
+    request = json.loads(sys.stdin.readline())
+
+    logger = logging.getLogger()
+    logger.handlers = []
+    logger.setLevel(request.get('log_level', logging.INFO))
+    logger.addHandler(_FrameLogHandler(writer))
+
+    import gettext
+    gettext.install("antergos-welcomed")
+
+    command = request.get('command')
+    if command not in COMMANDS:
+        writer.write(encode_result(False, "Unknown command {}".format(command)))
+        return 1
+
+    def report_progress(phase, package, done, total, percent):
+        writer.write(encode_progress(phase, str(package or ""), done, total, percent))
+
+    try:
+        from pacman import pac
+        alpm = pac.Pac(progress_callback=report_progress)
+        alpm.transfer_callback = lambda url, nbytes, seconds, ok: writer.write(
+            encode_transfer(url, nbytes, seconds, ok))
+        if 'hedge_delay' in request:
+            alpm.set_hedge_delay(request['hedge_delay'])
+        if 'fetch_workers' in request:
+            alpm.set_fetch_workers(request['fetch_workers'])
+    except Exception as err:
+        writer.write(encode_result(False, "Cannot initialize alpm library: {}".format(err)))
+        return 1
+
+    reader = threading.Thread(target=_read_commands, args=(alpm,))
+    reader.daemon = True
+    reader.start()
+
+    try:
+        if command == 'install':
+            ret = alpm.install(request['packages'])
+        elif command == 'remove':
+            ret = alpm.remove(request['packages'])
+        elif command == 'system_upgrade':
+            ret = alpm.system_upgrade()
+        else:
+            ret = alpm.prefetch_upgrades()
+    except Exception as err:
+        writer.write(encode_result(False, str(err)))
+        return 1
+    finally:
+        alpm.shutdown()
+    # None and 0 mean there was nothing to do
+    writer.write(encode_result(ret is not False))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(child_main())